@@ -0,0 +1,189 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from typing import Any
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+
+# rough token estimate used for the reported prompt sizes
+CHARS_PER_TOKEN = 4
+# appended to the question of a plan to ask it several times at once, every copy
+# progresses through the plan on its own
+RUN_SUFFIX = " (run {})"
+_RUN_SUFFIX = re.compile(r" \(run \d+\)")
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Chat model replaying the plan of each corpus question: fetch the metadata, run
+    the planned SQL queries one per generation, run the python script and answer.
+    The question is recognized in the prompt, the evaluator (or the generation through
+    the finish tool) keeps asking for more data until every planned query ran.
+    `latency` seconds are waited on every call. With `parallel_tool_calls` the queries of
+    plans marked `independent_sql` are all requested in the same message. Copies of a
+    question with different `RUN_SUFFIX`es progress through its plan independently"""
+
+    plans: list[dict]
+    latency: float = 0.0
+    parallel_tool_calls: bool = False
+    _progress: dict[str, int] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._progress.clear()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result(messages, kwargs)
+
+    async def _agenerate(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result(messages, kwargs)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for chunk in self._chunks(messages, kwargs):
+            if run_manager is not None:
+                run_manager.on_llm_new_token(str(chunk.message.content), chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(messages, kwargs):
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(
+                    str(chunk.message.content), chunk=chunk
+                )
+            yield chunk
+
+    def _chunks(self, messages: list[BaseMessage], kwargs: dict) -> list:
+        """Text responses word by word, tool calls in a single chunk"""
+        message = self._result(messages, kwargs).generations[0].message
+        if message.tool_calls:
+            return [
+                ChatGenerationChunk(
+                    message=AIMessageChunk(
+                        content="",
+                        tool_call_chunks=[
+                            {
+                                "name": call["name"],
+                                "args": json.dumps(call["args"]),
+                                "id": call["id"],
+                                "index": i,
+                            }
+                            for i, call in enumerate(message.tool_calls)
+                        ],
+                        usage_metadata=message.usage_metadata,
+                    )
+                )
+            ]
+        words = re.findall(r"\S+\s*", str(message.content)) or [""]
+        return [
+            ChatGenerationChunk(
+                message=AIMessageChunk(
+                    content=word,
+                    # usage is reported with the last chunk, as the real APIs do
+                    usage_metadata=(
+                        message.usage_metadata if i == len(words) - 1 else None
+                    ),
+                )
+            )
+            for i, word in enumerate(words)
+        ]
+
+    def _result(self, messages: list[BaseMessage], kwargs: dict) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        # tools are bound by LoggedChatModel in the OpenAI function format
+        tools = [tool["function"]["name"] for tool in kwargs.get("tools", [])]
+        message = self._respond(prompt, tools)
+        output = str(message.content) + str(message.tool_calls)
+        message.usage_metadata = {
+            "input_tokens": len(prompt) // CHARS_PER_TOKEN,
+            "output_tokens": len(output) // CHARS_PER_TOKEN,
+            "total_tokens": (len(prompt) + len(output)) // CHARS_PER_TOKEN,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _respond(self, prompt: str, tools: list[str]) -> AIMessage:
+        plan = self._find_plan(prompt)
+        run = self._run_key(plan, prompt)
+        # copies of the plan asked at once must not overwrite each other's results
+        name = re.sub(r"\W+", "_", run).strip("_")
+        steps = ["fetch_metadata"] + plan["sql"]
+
+        if "execute_sql" in tools:
+            batch = 1
+            if self.parallel_tool_calls and plan.get("independent_sql"):
+                batch = len(plan["sql"])
+            with self._lock:
+                step = self._progress.get(run, 0)
+                if step == 0 and (
+                    "fetch_metadata" not in tools
+                    or "No metadata fetched yet" not in prompt
+                ):
+                    # metadata prefetched or carried over from a previous question
+                    step = 1
+                self._progress[run] = step + (batch if step > 0 else 1)
+            if step >= len(steps):
+                if "finish_data_fetching" in tools:
+                    return _tool_call("finish_data_fetching", reason="Data fetched")
+                return AIMessage(content="No more data is needed")
+            if step == 0:
+                return _tool_call("fetch_metadata", user_question=plan["question"])
+            return _tool_calls(
+                [
+                    (
+                        "execute_sql",
+                        {"query": query, "meaningful_filename": f"{name}_{i}"},
+                    )
+                    for i, query in enumerate(steps[step : step + batch], start=step)
+                ]
+            )
+
+        if "python_interpreter" in tools:
+            code = plan.get("python") or "print('No further processing needed')"
+            code = code.replace(f"load_result('{plan['id']}_", f"load_result('{name}_")
+            return _tool_call("python_interpreter", code=code)
+
+        if "strict evaluator" in prompt:
+            with self._lock:
+                done = self._progress.get(run, 0) >= len(steps)
+            return AIMessage(content="DATA IS EXAUSTIVE" if done else "MISSING DATA")
+
+        return AIMessage(content=plan["answer"])
+
+    def _run_key(self, plan: dict, prompt: str) -> str:
+        end = prompt.index(plan["question"]) + len(plan["question"])
+        suffix = _RUN_SUFFIX.match(prompt, end)
+        return plan["id"] + (suffix.group(0) if suffix else "")
+
+    def _find_plan(self, prompt: str) -> dict:
+        for plan in self.plans:
+            if plan["question"] in prompt:
+                return plan
+        raise ValueError(f"No scripted plan for prompt: {prompt[:200]!r}")
+
+
+def _tool_call(name: str, **args: Any) -> AIMessage:
+    return _tool_calls([(name, args)])
+
+
+def _tool_calls(calls: list[tuple[str, dict]]) -> AIMessage:
+    return AIMessage(
+        content="",
+        tool_calls=[
+            {"name": name, "args": args, "id": f"{name}-{i}-{time.time_ns()}"}
+            for i, (name, args) in enumerate(calls)
+        ],
+    )
@@ -0,0 +1,526 @@
+"""Offline end-to-end benchmark of Text2SqlAgent: a scripted chat model replays the plan
+of every question of a fixed corpus against a local SQLite copy of a fixture schema.
+
+    python -m benchmarks.run [--repeat 3] [--llm_latency 0.5] [--baseline results.json]
+
+`--concurrency N` answers N questions at once on one event loop and reports the
+throughput against answering them one at a time.
+
+Results are written as JSON (one file per commit by default) to compare them between
+commits: `--baseline` prints the change of every summary metric against a previous run.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+FIXTURES_DIRECTORY = os.path.join(BENCHMARKS_DIRECTORY, "fixtures")
+RESULTS_DIRECTORY = os.path.join(BENCHMARKS_DIRECTORY, "results")
+# summary metrics compared against the baseline, lower is better for all of them
+SUMMARY_METRICS = [
+    "first_token_p50",
+    "latency_p50",
+    "latency_p95",
+    "latency_mean",
+    "llm_calls_mean",
+    "evaluation_calls_mean",
+    "prompt_tokens_mean",
+    "node_visits_mean",
+    "sql_executions_mean",
+    "peak_memory_mb",
+]
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    # the agent writes results, generated code and logs in its working directory
+    working_directory = args.working_directory
+    os.makedirs(working_directory, exist_ok=True)
+    shutil.copy(os.path.join(FIXTURES_DIRECTORY, "schema.yaml"), working_directory)
+    os.chdir(working_directory)
+
+    from src.agent.graph import Text2SqlAgent
+    from src.agent.llm_backend import LoggedChatModel
+    from src.catalog import get_catalog
+    from src.config import Config, ModelSettings
+    from src.db import use_client
+    from src.logger import configure_logger
+    from benchmarks.fake_llm import ScriptedChatModel
+    from benchmarks.sqlite_backend import SqliteClient
+
+    with open(args.questions, encoding="utf-8") as f:
+        plans = [json.loads(line) for line in f if line.strip()]
+    config = Config(
+        language="en",
+        model_name="scripted",
+        gcp_project="benchmark",
+        provider="offline",
+        model_settings=ModelSettings(temperature=0.0),
+        log_level=args.log_level,
+        warm_up_db=False,
+        query_cache_enabled=args.query_cache,
+        metadata_char_budget=args.metadata_char_budget,
+        prompt_token_budget=args.prompt_token_budget,
+        sufficiency_evaluation=args.sufficiency_evaluation,
+        skip_lookup_evaluation=not args.no_lookup_skip,
+        max_concurrent_queries=args.max_concurrent_queries,
+        message_window=args.message_window,
+        metadata_prefetch=not args.no_metadata_prefetch,
+    )
+    configure_logger(config)
+
+    setup_start = time.perf_counter()
+    model = ScriptedChatModel(
+        plans=plans,
+        latency=args.llm_latency,
+        parallel_tool_calls=args.parallel_tool_calls,
+    )
+    agent = Text2SqlAgent(config, llm=LoggedChatModel(model))
+    use_client(SqliteClient(get_catalog(), rows_per_table=args.rows))
+    setup_seconds = time.perf_counter() - setup_start
+    _check_direct_tool_calls(next(iter(get_catalog().tables)))
+
+    # warms up the interpreter pool and lazy imports, not measured
+    model.reset()
+    agent.invoke(plans[0]["question"])
+
+    results = []
+    sequential_seconds = None
+    answering_start = time.perf_counter()
+    if args.concurrency > 1:
+        # the questions of one run answered one at a time, to compare the throughput with
+        model.reset()
+        asyncio.run(_run_concurrently(agent, [(plan, 0) for plan in plans], 1))
+        sequential_seconds = time.perf_counter() - answering_start
+        # every run of the corpus at once, as many questions as wanted can be in flight
+        model.reset()
+        answering_start = time.perf_counter()
+        results = asyncio.run(
+            _run_concurrently(
+                agent,
+                [
+                    (plan, repetition)
+                    for repetition in range(args.repeat)
+                    for plan in plans
+                ],
+                args.concurrency,
+            )
+        )
+    else:
+        for repetition in range(args.repeat):
+            # with --session every run of the corpus is a single conversation
+            session_id = f"benchmark-{repetition}" if args.session else None
+            for plan in plans:
+                model.reset()
+                results.append(
+                    _run_question(
+                        agent,
+                        plan,
+                        repetition,
+                        args.concurrent,
+                        session_id,
+                        args.stream,
+                    )
+                )
+    answering_seconds = time.perf_counter() - answering_start
+
+    throughput = {"throughput_qps": len(results) / answering_seconds}
+    if sequential_seconds is not None:
+        throughput["sequential_qps"] = len(plans) / sequential_seconds
+        throughput["speedup"] = (
+            throughput["throughput_qps"] / throughput["sequential_qps"]
+        )
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "repeat": args.repeat,
+            "rows": args.rows,
+            "llm_latency": args.llm_latency,
+            "query_cache": args.query_cache,
+            "prompt_token_budget": args.prompt_token_budget,
+            "sufficiency_evaluation": args.sufficiency_evaluation,
+            "lookup_skip": not args.no_lookup_skip,
+            "parallel_tool_calls": args.parallel_tool_calls,
+            "max_concurrent_queries": args.max_concurrent_queries,
+            "message_window": args.message_window,
+            "session": args.session,
+            "metadata_prefetch": not args.no_metadata_prefetch,
+            "async": args.concurrent,
+            "concurrency": args.concurrency,
+            "stream": args.stream,
+            "questions": len(plans),
+        },
+        "setup_seconds": setup_seconds,
+        "summary": _summarize(results),
+        "throughput": throughput,
+        "questions": results,
+    }
+
+
+def _check_direct_tool_calls(table: str) -> None:
+    """Tools must keep working when invoked directly, outside of a graph run"""
+    from src.agent.tools import SQL_EXECUTION_ERROR_PREFIX, execute_sql
+
+    call = {"query": f"SELECT * FROM {table} LIMIT 1", "meaningful_filename": "direct"}
+    for output in (execute_sql.invoke(call), asyncio.run(execute_sql.ainvoke(call))):
+        if output.startswith(SQL_EXECUTION_ERROR_PREFIX):
+            raise RuntimeError(f"Direct execute_sql call failed: {output}")
+
+
+def _run_question(
+    agent,
+    plan: dict,
+    repetition: int,
+    use_async: bool,
+    session_id: str | None,
+    use_stream: bool,
+) -> dict:
+    start = time.perf_counter()
+    first_token = None
+    error = None
+    try:
+        if use_stream:
+            first_token = _stream_question(
+                agent, plan["question"], session_id, use_async
+            )
+        elif use_async:
+            asyncio.run(agent.ainvoke(plan["question"], session_id=session_id))
+        else:
+            agent.invoke(plan["question"], session_id=session_id)
+    except Exception as e:
+        error = repr(e)
+    latency = time.perf_counter() - start
+    return _question_result(
+        plan, repetition, latency, first_token, error, agent.last_trace
+    )
+
+
+async def _run_concurrently(
+    agent, questions: list[tuple[dict, int]], concurrency: int
+) -> list[dict]:
+    """Answers the `(plan, repetition)` questions through `ainvoke` on a single event
+    loop, `concurrency` of them at a time. The repetition is appended to the question
+    so that the scripted model tells the copies of a plan apart"""
+    from benchmarks.fake_llm import RUN_SUFFIX
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(plan: dict, repetition: int) -> dict:
+        async with slots:
+            start = time.perf_counter()
+            error = None
+            try:
+                await agent.ainvoke(plan["question"] + RUN_SUFFIX.format(repetition))
+            except Exception as e:
+                error = repr(e)
+            latency = time.perf_counter() - start
+            # read before giving control back to the event loop, the trace of the
+            # next question to complete replaces it
+            current = agent.last_trace
+        return _question_result(plan, repetition, latency, None, error, current)
+
+    return await asyncio.gather(
+        *(run(plan, repetition) for plan, repetition in questions)
+    )
+
+
+def _question_result(
+    plan: dict,
+    repetition: int,
+    latency: float,
+    first_token: float | None,
+    error: str | None,
+    current_trace,
+) -> dict:
+    if first_token is None:
+        # without streaming the answer is seen all at once at the end
+        first_token = latency
+
+    spans = current_trace.spans if current_trace is not None else []
+    node_visits = {}
+    for span in spans:
+        if span["kind"] == "node":
+            node_visits[span["name"]] = node_visits.get(span["name"], 0) + 1
+    llm_spans = [span for span in spans if span["kind"] == "llm"]
+    llm_calls_by_node = {}
+    for span in llm_spans:
+        llm_calls_by_node[span["name"]] = llm_calls_by_node.get(span["name"], 0) + 1
+    sql_spans = [
+        span
+        for span in spans
+        if span["kind"] == "tool" and span["name"] == "execute_sql"
+    ]
+    python_spans = [
+        span
+        for span in spans
+        if span["kind"] == "tool" and span["name"] == "python_interpreter"
+    ]
+    return {
+        "id": plan["id"],
+        "repetition": repetition,
+        "latency": latency,
+        "first_token_latency": first_token,
+        "error": error,
+        "node_visits": node_visits,
+        "llm_calls": len(llm_spans),
+        "llm_calls_by_node": llm_calls_by_node,
+        "prompt_tokens": sum(s["counters"].get("input_tokens", 0) for s in llm_spans),
+        "sql_executions": len(sql_spans),
+        "sql_failures": sum(s["counters"].get("failures", 0) for s in sql_spans),
+        "bytes_processed": sum(
+            s["counters"].get("bytes_processed", 0) for s in sql_spans
+        ),
+        "python_failures": sum(s["counters"].get("failures", 0) for s in python_spans),
+        "peak_memory_mb": _peak_memory_mb(),
+    }
+
+
+def _stream_question(
+    agent, question: str, session_id: str | None, use_async: bool
+) -> float | None:
+    """Consumes the event stream of `question`, returns the seconds it took for
+    the first answer token to arrive"""
+    start = time.perf_counter()
+    first_token = None
+
+    def on_event(event: dict) -> None:
+        nonlocal first_token
+        if event["event"] == "answer_token" and first_token is None:
+            first_token = time.perf_counter() - start
+
+    if use_async:
+
+        async def consume():
+            async for event in agent.astream(question, session_id=session_id):
+                on_event(event)
+
+        asyncio.run(consume())
+    else:
+        for event in agent.stream(question, session_id=session_id):
+            on_event(event)
+    return first_token
+
+
+def _summarize(results: list[dict]) -> dict:
+    latencies = sorted(result["latency"] for result in results)
+
+    def mean(key):
+        if not results:
+            return 0.0
+        return sum(
+            sum(r[key].values()) if isinstance(r[key], dict) else r[key]
+            for r in results
+        ) / len(results)
+
+    def mean_calls(node):
+        if not results:
+            return 0.0
+        return sum(r["llm_calls_by_node"].get(node, 0) for r in results) / len(results)
+
+    first_tokens = sorted(result["first_token_latency"] for result in results)
+    return {
+        "first_token_p50": _percentile(first_tokens, 50),
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p95": _percentile(latencies, 95),
+        "latency_mean": mean("latency"),
+        "llm_calls_mean": mean("llm_calls"),
+        "evaluation_calls_mean": mean_calls("context_eval"),
+        "prompt_tokens_mean": mean("prompt_tokens"),
+        "node_visits_mean": mean("node_visits"),
+        "sql_executions_mean": mean("sql_executions"),
+        "peak_memory_mb": _peak_memory_mb(),
+        "errors": sum(1 for result in results if result["error"]),
+        "python_failures": sum(result["python_failures"] for result in results),
+    }
+
+
+def _percentile(ordered: list[float], percentile: float) -> float:
+    if not ordered:
+        return 0.0
+    # nearest rank
+    rank = max(int(round(percentile / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _peak_memory_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPOSITORY_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_report(report: dict, baseline: dict | None) -> None:
+    print(
+        f"{report['settings']['questions']} questions x {report['settings']['repeat']} "
+        f"at commit {report['commit']} (setup {report['setup_seconds']:.2f}s)"
+    )
+    for metric in SUMMARY_METRICS:
+        value = report["summary"][metric]
+        line = f"  {metric:<22} {value:12.3f}"
+        if baseline is not None and metric in baseline["summary"]:
+            previous = baseline["summary"][metric]
+            change = (value - previous) / previous * 100 if previous else 0.0
+            line += f"  (baseline {previous:.3f}, {change:+.1f}%)"
+        print(line)
+    for metric in ("errors", "python_failures"):
+        print(f"  {metric:<22} {report['summary'][metric]:12d}")
+    # higher is better, not compared with the baseline
+    for metric, value in report["throughput"].items():
+        print(f"  {metric:<22} {value:12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end agent benchmark")
+    parser.add_argument(
+        "--questions",
+        type=str,
+        default=os.path.join(FIXTURES_DIRECTORY, "questions.jsonl"),
+        help="JSONL corpus of questions with their scripted plans",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the corpus")
+    parser.add_argument(
+        "--rows", type=int, default=20000, help="Synthetic rows of every table"
+    )
+    parser.add_argument(
+        "--llm_latency",
+        type=float,
+        default=0.0,
+        help="Seconds every scripted LLM call waits, to emulate the API",
+    )
+    parser.add_argument(
+        "--query_cache", action="store_true", help="Enable the query result cache"
+    )
+    parser.add_argument(
+        "--metadata_char_budget",
+        type=int,
+        default=5000,
+        help="Metadata longer than this is narrowed down by retrieval",
+    )
+    parser.add_argument(
+        "--prompt_token_budget",
+        type=int,
+        default=8000,
+        help="Ceiling on the estimated tokens of every node system prompt",
+    )
+    parser.add_argument(
+        "--sufficiency_evaluation",
+        choices=["llm", "inline"],
+        default="llm",
+        help="Separate evaluation LLM call or finish tool of the generation node",
+    )
+    parser.add_argument(
+        "--no_lookup_skip",
+        action="store_true",
+        help="Always evaluate sufficiency, even for lookup questions",
+    )
+    parser.add_argument(
+        "--parallel_tool_calls",
+        action="store_true",
+        help="Request the independent queries of a question in a single message",
+    )
+    parser.add_argument(
+        "--max_concurrent_queries",
+        type=int,
+        default=4,
+        help="Queries run at the same time by concurrent tool calls",
+    )
+    parser.add_argument(
+        "--message_window",
+        type=int,
+        default=30,
+        help="Messages kept in the graph state, 0 keeps all of them",
+    )
+    parser.add_argument(
+        "--no_metadata_prefetch",
+        action="store_true",
+        help="Let the model ask for the metadata instead of prefetching it",
+    )
+    parser.add_argument(
+        "--session",
+        action="store_true",
+        help="Ask the questions of every run as follow-ups of the same session",
+    )
+    parser.add_argument(
+        "--async",
+        dest="concurrent",
+        action="store_true",
+        help="Answer through `ainvoke` instead of `invoke`",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Questions answered at the same time through `ainvoke`, the runs of the "
+        "corpus all at once. The throughput is compared with answering one at a time",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Answer through `stream` and measure the first answer token latency",
+    )
+    parser.add_argument("--log_level", type=str, default="WARNING")
+    parser.add_argument(
+        "--keep_files",
+        action="store_true",
+        help="Keep the results, generated code and logs written by the agent",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="JSON results file, defaults to results/<commit>.json",
+    )
+    parser.add_argument(
+        "--baseline", type=str, help="Previous JSON results to compare with"
+    )
+    args = parser.parse_args()
+    if args.concurrency > 1 and (args.session or args.stream):
+        parser.error("--concurrency can't be combined with --session or --stream")
+    # paths given on the command line are relative to where the benchmark is started
+    args.questions = os.path.abspath(args.questions)
+    output = os.path.abspath(
+        args.output
+        or os.path.join(RESULTS_DIRECTORY, f"{_git_commit() or 'local'}.json")
+    )
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    args.working_directory = tempfile.mkdtemp(prefix="text2sql-benchmark-")
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    try:
+        report = run_benchmark(args)
+    finally:
+        if args.keep_files:
+            print(f"Agent files kept in {args.working_directory}")
+        else:
+            shutil.rmtree(args.working_directory, ignore_errors=True)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    _print_report(report, baseline)
+    print(f"Results written to {output}")
@@ -0,0 +1,194 @@
+import datetime
+import random
+import sqlite3
+import threading
+from google.cloud import bigquery
+from google.cloud.bigquery.table import Row
+import sqlglot
+from src.catalog import SchemaCatalog
+
+
+SQLITE_TYPES = {
+    "INT64": "INTEGER",
+    "INTEGER": "INTEGER",
+    "NUMERIC": "REAL",
+    "FLOAT64": "REAL",
+    "FLOAT": "REAL",
+    "BOOL": "INTEGER",
+    "BOOLEAN": "INTEGER",
+}
+CATEGORIES = {
+    "status": ["placed", "shipped", "delivered", "delivered", "delivered", "returned"],
+    "country": ["Italy", "Germany", "France", "Spain", "Netherlands", "Poland"],
+    "segment": ["consumer", "consumer", "business", "reseller"],
+    "category": ["books", "electronics", "garden", "toys", "clothing", "food"],
+    "channel": ["email", "search", "social", "display"],
+}
+FIRST_DATE = datetime.date(2022, 1, 1)
+
+
+class SqliteClient:
+    """Local stand-in for `bigquery.Client` running queries on an in memory SQLite
+    database, with one attached schema per dataset of the catalog filled with
+    deterministic synthetic rows. Queries are transpiled from the BigQuery dialect.
+    Implements only what `src.db` uses to run queries"""
+
+    def __init__(self, catalog: SchemaCatalog, rows_per_table: int, seed: int = 0):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        # the connection is shared by the worker threads of the agent
+        self._lock = threading.Lock()
+        self._rows_per_table = rows_per_table
+        random_generator = random.Random(seed)
+        for dataset in catalog.datasets:
+            self._conn.execute(f"ATTACH DATABASE ':memory:' AS {dataset}")
+        for full_table_name, table in catalog.tables.items():
+            self._create_table(full_table_name, table, random_generator)
+        self._conn.commit()
+
+    def query(self, query: str, job_config=None, timeout=None) -> "SqliteJob":
+        if job_config is not None and job_config.dry_run:
+            return SqliteJob([], [], [])
+
+        sqlite_query = sqlglot.transpile(query, read="bigquery", write="sqlite")[0]
+        with self._lock:
+            cursor = self._conn.execute(sqlite_query)
+            rows = cursor.fetchall()
+        column_names = [column[0] for column in cursor.description]
+        tables = {
+            f"{table.db}.{table.name}"
+            for table in sqlglot.parse_one(query, read="bigquery").find_all(
+                sqlglot.exp.Table
+            )
+            if table.db
+        }
+        return SqliteJob(column_names, rows, sorted(tables))
+
+    def list_datasets(self, max_results=None) -> list:
+        return []
+
+    def _create_table(
+        self, full_table_name: str, table: dict, random_generator: random.Random
+    ) -> None:
+        columns = table.get("columns", [])
+        definitions = ", ".join(
+            f"{c['name']} {SQLITE_TYPES.get(c['type'], 'TEXT')}" for c in columns
+        )
+        self._conn.execute(f"CREATE TABLE {full_table_name} ({definitions})")
+
+        table_name = full_table_name.split(".")[-1]
+        # orders.order_id, customers.customer_id...
+        primary_key = next(
+            (
+                c["name"]
+                for c in columns
+                if c["name"].endswith("_id")
+                and table_name.startswith(c["name"].removesuffix("_id"))
+            ),
+            None,
+        )
+        rows = [
+            [
+                _fake_value(
+                    column,
+                    i,
+                    self._rows_per_table,
+                    random_generator,
+                    column["name"] == primary_key,
+                )
+                for column in columns
+            ]
+            for i in range(self._rows_per_table)
+        ]
+        placeholders = ", ".join("?" for _ in columns)
+        self._conn.executemany(
+            f"INSERT INTO {full_table_name} VALUES ({placeholders})", rows
+        )
+
+
+class SqliteJob:
+    """Already completed query job"""
+
+    def __init__(self, column_names: list[str], rows: list[tuple], tables: list[str]):
+        self._rows = rows
+        self.schema = [
+            bigquery.SchemaField(name, _bigquery_type(rows, i))
+            for i, name in enumerate(column_names)
+        ]
+        self.referenced_tables = [
+            bigquery.TableReference.from_string(f"benchmark.{table}")
+            for table in tables
+        ]
+        # what BigQuery would bill, roughly
+        self.total_bytes_processed = 8 * len(column_names) * len(rows)
+
+    def done(self) -> bool:
+        return True
+
+    def result(self, page_size: int | None = None) -> "SqliteRowIterator":
+        return SqliteRowIterator(self.schema, self._rows, page_size)
+
+
+class SqliteRowIterator:
+    def __init__(self, schema: list, rows: list[tuple], page_size: int | None):
+        self.schema = schema
+        self.total_rows = len(rows)
+        self._rows = rows
+        self._page_size = page_size or max(len(rows), 1)
+        self._field_to_index = {field.name: i for i, field in enumerate(schema)}
+
+    @property
+    def pages(self):
+        for start in range(0, len(self._rows), self._page_size):
+            yield [
+                Row(values, self._field_to_index)
+                for values in self._rows[start : start + self._page_size]
+            ]
+
+    def to_arrow_iterable(self, **kwargs):
+        import pyarrow as pa
+
+        names = [field.name for field in self.schema]
+        for start in range(0, len(self._rows), self._page_size):
+            page = self._rows[start : start + self._page_size]
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(column) for column in zip(*page)], names=names
+            )
+
+
+def _fake_value(
+    column: dict,
+    index: int,
+    rows: int,
+    random_generator: random.Random,
+    primary_key: bool,
+):
+    name, column_type = column["name"], column["type"]
+    if primary_key:
+        return index + 1
+    if name.endswith("_id"):
+        # every table has the same number of rows, so foreign keys always match
+        return random_generator.randint(1, rows)
+    if name in CATEGORIES:
+        return random_generator.choice(CATEGORIES[name])
+    if column_type in ("INT64", "INTEGER"):
+        return random_generator.randint(1, 10)
+    if column_type in ("NUMERIC", "FLOAT64", "FLOAT"):
+        return round(random_generator.uniform(1, 500), 2)
+    if column_type == "DATE":
+        days = random_generator.randint(0, 3 * 365)
+        return (FIRST_DATE + datetime.timedelta(days=days)).isoformat()
+    return f"{name} {random_generator.randint(1, rows)}"
+
+
+def _bigquery_type(rows: list[tuple], index: int) -> str:
+    for row in rows:
+        value = row[index]
+        if isinstance(value, bool):
+            return "BOOL"
+        if isinstance(value, int):
+            return "INT64"
+        if isinstance(value, float):
+            return "FLOAT64"
+        if value is not None:
+            return "STRING"
+    return "STRING"
@@ -1,10 +1,49 @@
-from langchain.messages import HumanMessage
-from src.agent.graph import Text2SqlAgent, llm_nodes, tool_nodes, llm_control_nodes
+from concurrent.futures import ThreadPoolExecutor
+from src.batch import read_questions, run_batch
 from src.config import read_config, Config
-from src.db import gcp_pull_metadata, get_table_metadata
 from src.logger import configure_logger, logger
-from src.utils import print_graph
 import argparse
+import sys
+import uuid
+
+# the agent, BigQuery and LangGraph modules are heavy to import: they are imported
+# when first needed so that the CLI starts right away
+
+
+def build_agent(config: Config, render_graph: bool):
+    from src.agent.graph import (
+        Text2SqlAgent,
+        llm_control_nodes,
+        llm_nodes,
+        tool_nodes,
+    )
+
+    agent = Text2SqlAgent(config)
+    if render_graph:
+        from src.utils import print_graph
+
+        print_graph(
+            agent.graph,
+            llm_nodes=llm_nodes,
+            llm_control_nodes=llm_control_nodes,
+            tool_nodes=tool_nodes,
+        )
+    return agent
+
+
+def print_stream(events) -> None:
+    """Prints the progress of the agent on stderr and the answer on stdout as they arrive"""
+    for event in events:
+        if event["event"] == "node_entered":
+            print(f"... {event['node']}", file=sys.stderr, flush=True)
+        elif event["event"] == "query_running":
+            print(f"... running query {event['filename']}", file=sys.stderr, flush=True)
+        elif event["event"] == "rows_fetched":
+            print(f"... {event['rows']} rows fetched", file=sys.stderr, flush=True)
+        elif event["event"] == "answer_token":
+            print(event["text"], end="", flush=True)
+        elif event["event"] == "answer":
+            print()
 
 
 def override_config_with_args(config: Config, args: argparse.Namespace) -> Config:
@@ -18,6 +57,8 @@ def override_config_with_args(config: Config, args: argparse.Namespace) -> Confi
         "provider": "provider",
         "log_level": "log_level",
         "temperature": "model_settings.temperature",
+        "metadata_concurrency": "metadata_concurrency",
+        "batch_workers": "batch_workers",
     }
 
     config_copy = config.__dict__.copy()
@@ -55,6 +96,41 @@ if __name__ == "__main__":
     parser.add_argument(
         "--question", type=str, help="Question to ask the agent (single query mode)"
     )
+    parser.add_argument(
+        "--session_id",
+        type=str,
+        help="Session to continue, its previous questions share their data with the new ones",
+    )
+    parser.add_argument(
+        "--questions_file",
+        "--questions-file",
+        type=str,
+        help="JSONL or CSV file of questions to answer in batch mode",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="answers.jsonl",
+        help="JSONL file the batch mode answers are appended to",
+    )
+    parser.add_argument(
+        "--batch_workers", type=int, help="Worker processes used in batch mode"
+    )
+    parser.add_argument(
+        "--render_graph",
+        action="store_true",
+        help="Render the agent graph to graph.png (or graph.mmd when offline)",
+    )
+    parser.add_argument(
+        "--pull_metadata",
+        action="store_true",
+        help="Pull the project metadata into schema.yaml and exit",
+    )
+    parser.add_argument(
+        "--metadata_concurrency",
+        type=int,
+        help="Concurrent requests used when pulling metadata",
+    )
 
     args = parser.parse_args()
 
@@ -64,23 +140,38 @@ if __name__ == "__main__":
     configure_logger(config)
     # has to be after the configure_logger call
     logger.debug(f"Loaded config: {config}")
-    agent = Text2SqlAgent(config)
-    print_graph(
-        agent.graph,
-        llm_nodes=llm_nodes,
-        llm_control_nodes=llm_control_nodes,
-        tool_nodes=tool_nodes,
-    )
+    if args.pull_metadata:
+        from src.db import gcp_pull_metadata
+
+        gcp_pull_metadata(config.gcp_project, max_workers=config.metadata_concurrency)
+        exit(0)
+    if args.questions_file:
+        run_batch(
+            config,
+            read_questions(args.questions_file),
+            output_path=args.output,
+            workers=config.batch_workers,
+        )
+        exit(0)
 
+    # follow-up questions reuse the metadata and results fetched by the previous ones
+    session_id = args.session_id or uuid.uuid4().hex
     if args.question:
-        answer = agent.invoke(args.question)
-        print(answer)
+        agent = build_agent(config, args.render_graph)
+        print_stream(agent.stream(args.question, session_id=args.session_id))
     else:
-        while True:
-            question = input("> ")
-            if question == "/quit":
-                break
+        # the agent is built while the user types the first question
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            agent_future = executor.submit(build_agent, config, args.render_graph)
+            while True:
+                question = input("> ")
+                if question == "/quit":
+                    break
+                if question == "/new":
+                    session_id = uuid.uuid4().hex
+                    print("Started a new session")
+                    continue
 
-            answer = agent.invoke(question)
-            print(answer)
+                agent = agent_future.result()
+                print_stream(agent.stream(question, session_id=session_id))
         print("Bye!")
@@ -0,0 +1,146 @@
+from dataclasses import dataclass
+import re
+from typing import Callable
+from src.logger import logger
+from src.metrics import increment
+from src.retrieval import BM25Index, tokenize
+
+
+# rough estimate, good enough to enforce a ceiling without a model specific tokenizer
+CHARS_PER_TOKEN = 4
+# sections are first cut down to this size, then further if the budget still isn't met
+MIN_SECTION_TOKENS = 200
+# room left for the notes telling the model what was omitted
+NOTE_TOKENS = 25
+
+_TABLE_BLOCK = re.compile(r"(?m)^(?=Table: )")
+_RESULT_BLOCK = re.compile(r"(?m)^(?=\(The full query result)")
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_middle(text: str, max_tokens: int, question: str = "") -> str:
+    """Keeps the beginning and the end of `text`, where results and errors usually are"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max(max_tokens - NOTE_TOKENS, 0) * CHARS_PER_TOKEN // 2
+    if keep == 0:
+        return "(omitted to fit the context budget)"
+    omitted = len(text) - 2 * keep
+    return f"{text[:keep]}\n...({omitted} characters omitted)...\n{text[-keep:]}"
+
+
+def shrink_metadata(text: str, max_tokens: int, question: str) -> str:
+    """Keeps the table descriptions most relevant to `question` that fit in `max_tokens`"""
+    blocks = [block for block in _TABLE_BLOCK.split(text) if block.strip()]
+    if len(blocks) < 2:
+        return truncate_middle(text, max_tokens)
+
+    index = BM25Index({i: tokenize(block) for i, block in enumerate(blocks)})
+    ranked = [i for i, _ in index.search(question)]
+    ranked += [i for i in range(len(blocks)) if i not in ranked]
+
+    kept = set()
+    used = NOTE_TOKENS
+    for i in ranked:
+        size = estimate_tokens(blocks[i])
+        if used + size > max_tokens:
+            continue
+        kept.add(i)
+        used += size
+    if not kept:
+        # the best table alone is over budget
+        return truncate_middle(blocks[ranked[0]], max_tokens)
+
+    shrunk = "".join(blocks[i] for i in sorted(kept))
+    return shrunk + f"({len(blocks) - len(kept)} less relevant tables omitted)\n"
+
+
+def shrink_data_preview(text: str, max_tokens: int, question: str = "") -> str:
+    """Keeps the result path line, the header and as many preview rows as fit.
+    Several results share the budget, what small ones don't use goes to the others"""
+    blocks = [block for block in _RESULT_BLOCK.split(text) if block]
+    if len(blocks) < 2:
+        return _shrink_result(text, max_tokens)
+
+    budgets = {}
+    remaining = max_tokens
+    by_size = sorted(range(len(blocks)), key=lambda i: estimate_tokens(blocks[i]))
+    for left, i in enumerate(by_size):
+        budgets[i] = min(estimate_tokens(blocks[i]), remaining // (len(blocks) - left))
+        remaining -= budgets[i]
+    return "".join(_shrink_result(block, budgets[i]) for i, block in enumerate(blocks))
+
+
+def _shrink_result(text: str, max_tokens: int) -> str:
+    lines = text.splitlines(keepends=True)
+    if len(lines) < 3 or not lines[0].startswith("(The full query result"):
+        # error messages and other tool outputs
+        return truncate_middle(text, max_tokens)
+
+    kept = lines[:2]
+    used = estimate_tokens("".join(kept)) + NOTE_TOKENS
+    if used > max_tokens:
+        return truncate_middle(text, max_tokens)
+    for line in lines[2:]:
+        size = estimate_tokens(line)
+        if used + size > max_tokens:
+            break
+        kept.append(line)
+        used += size
+    omitted = len(lines) - len(kept)
+    if omitted:
+        kept.append(
+            f"...({omitted} more preview rows omitted, load the full result file to see them)\n"
+        )
+    return "".join(kept)
+
+
+@dataclass
+class ContextSection:
+    """Variable part of a prompt, filled in the `name` placeholder. Sections with a lower
+    `priority` are cut first, `shrink(text, max_tokens, question)` does the cutting"""
+
+    name: str
+    text: str
+    priority: int
+    shrink: Callable[[str, int, str], str] = truncate_middle
+
+
+def assemble_context(
+    node: str,
+    template: str,
+    sections: list[ContextSection],
+    budget: int,
+    question: str,
+) -> dict[str, str]:
+    """Returns the text of every section by name, cut so that `template` filled with them
+    fits in `budget` estimated tokens"""
+    texts = {section.name: section.text for section in sections}
+    available = max(budget - estimate_tokens(template), 0)
+    original = sum(estimate_tokens(text) for text in texts.values())
+    if original <= available:
+        return texts
+
+    by_priority = sorted(sections, key=lambda section: section.priority)
+    # first pass keeps some of every section, the second one doesn't
+    for floor in (MIN_SECTION_TOKENS, 0):
+        for section in by_priority:
+            over = sum(estimate_tokens(text) for text in texts.values()) - available
+            if over <= 0:
+                break
+            size = estimate_tokens(texts[section.name])
+            target = max(size - over, min(floor, size))
+            if target < size:
+                texts[section.name] = section.shrink(
+                    texts[section.name], target, question
+                )
+
+    final = sum(estimate_tokens(text) for text in texts.values())
+    logger.debug(
+        f"{node} prompt context cut from {original} to {final} tokens (budget {budget})"
+    )
+    increment("context_tokens_saved", original - final)
+    return texts
@@ -4,12 +4,42 @@ from langchain.messages import (
     SystemMessage,
     HumanMessage,
 )
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
 from langgraph.prebuilt import ToolNode
-from typing import Callable
+import re
+import time
+import uuid
+from typing import AsyncIterator, Callable, Iterator
+from src.agent.context import (
+    ContextSection,
+    assemble_context,
+    shrink_data_preview,
+    shrink_metadata,
+    truncate_middle,
+)
 from src.agent.llm_backend import instantiate_llm
+from src.agent.progress import (
+    ANSWER,
+    ANSWER_TOKEN,
+    NODE_ENTERED,
+    emit_progress,
+)
+from src.agent.session import make_checkpointer, turn_input
 from src.agent.state import *
 from src.agent.tools import *
 from src.config import Config
+from src.db import configure_db
+from src.metrics import (
+    GRAPH,
+    NODE,
+    Trace,
+    export_metrics,
+    increment,
+    record,
+    span,
+    trace,
+)
 from src.prompts import prompts
 from src.utils import get_user_question, content_as_string
 from src.logger import logger
@@ -24,6 +54,7 @@ NODE_PYTHON_GENERATION_NAME = "python_generation"
 NODE_PYTHON_POST_TOOL_NAME = "python_tool_state_mngt"
 NODE_PYTHON_INTERPRETER_NAME = "python_interpreter"
 NODE_SUFFEVAL_NAME = "context_eval"
+NODE_PREFETCH_NAME = "metadata_prefetch"
 llm_control_nodes = [
     NODE_GENERATE_NAME,
     NODE_PYTHON_GENERATION_NAME,
@@ -32,45 +63,126 @@ llm_nodes = [
     NODE_ANSWER_NAME,
     NODE_SUFFEVAL_NAME,
 ]
-tool_nodes = [NODE_TOOLS_NAME, NODE_PYTHON_INTERPRETER_NAME]
+tool_nodes = [NODE_TOOLS_NAME, NODE_PYTHON_INTERPRETER_NAME, NODE_PREFETCH_NAME]
 
 EXECUTION_ERROR_PREFIX = "SQL execution error:"
+# progress events, answer tokens and the final state
+STREAM_MODES = ["custom", "messages", "values"]
+
+
+def _sync_async_node(func: Callable, afunc: Callable) -> RunnableLambda:
+    """Node running `func` when the graph is invoked and `afunc` when it's awaited"""
+    return RunnableLambda(func, afunc=afunc)
+
+
+def _timed_node(name: str, node: Callable | Runnable) -> RunnableLambda:
+    """Wraps `node` so that every run is recorded as a metrics span named `name` and
+    announced to the graph stream"""
+    if not isinstance(node, Runnable):
+        node = RunnableLambda(node)
+
+    def run(state: MessagesState, config: RunnableConfig):
+        emit_progress(NODE_ENTERED, node=name)
+        with span(NODE, name):
+            return node.invoke(state, config)
+
+    async def arun(state: MessagesState, config: RunnableConfig):
+        emit_progress(NODE_ENTERED, node=name)
+        with span(NODE, name):
+            return await node.ainvoke(state, config)
+
+    return RunnableLambda(run, afunc=arun, name=name)
 
 
 class Text2SqlAgent:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, llm: BaseChatModel | None = None):
+        """`llm` replaces the model instantiated from the config, e.g. with a fake one
+        for offline runs"""
         self.max_retries = config.max_retries
         self.local_prompts = prompts[config.language]
-        self.llm = instantiate_llm(config)
+        self.result_loading = self.local_prompts.result_loading[
+            config.query_result_format
+        ]
+        if uses_interpreter_pool(config):
+            # scripts running on the interpreter pool get the `load_result` helper
+            self.result_loading += " " + self.local_prompts.result_helper
+        self.llm = llm if llm is not None else instantiate_llm(config)
+        self.metrics_path = config.metrics_path
+        self.prompt_token_budget = config.prompt_token_budget
+        self.prompt_token_budgets = config.prompt_token_budgets
+        self.message_window = config.message_window
+        self.checkpointer = make_checkpointer(config)
+        self.session_max_results = config.session_max_results
+        self.session_ttl = config.session_ttl
+        # "inline": the generation node decides when data is enough by calling
+        # the finish tool, instead of a separate evaluation LLM call
+        self.inline_sufficiency = config.sufficiency_evaluation == "inline"
+        self.skip_lookup_evaluation = config.skip_lookup_evaluation
+        # patterns of the prompts language, an empty one never skips
+        self.lookup_question = re.compile(
+            self.local_prompts.lookup_question or r"(?!)", re.IGNORECASE
+        )
+        self.not_lookup_question = re.compile(
+            self.local_prompts.not_lookup_question, re.IGNORECASE
+        )
+        self.metadata_prefetch = config.metadata_prefetch
+        self.data_tools = [execute_sql, fetch_metadata]
+        if self.inline_sufficiency:
+            self.data_tools.append(finish_data_fetching)
+        # spans of the last answered question
+        self.last_trace: Trace | None = None
+        configure_db(config)
+        configure_tools(config)
 
         # Build workflow
         agent_builder = StateGraph(state_schema=MessagesState)
         # Add nodes
-        agent_builder.add_node(NODE_GENERATE_NAME, self._node_generate_sql)
-        agent_builder.add_node(NODE_TOOLS_NAME, ToolNode([execute_sql, fetch_metadata]))
-        agent_builder.add_node(
-            NODE_PYTHON_INTERPRETER_NAME, ToolNode([python_interpreter])
-        )
-        agent_builder.add_node(NODE_POST_TOOL_NAME, self._node_post_data_tool)
-        agent_builder.add_node(NODE_PYTHON_POST_TOOL_NAME, self._node_post_python_tool)
-        agent_builder.add_node(NODE_SUFFEVAL_NAME, self._node_sufficiency_evaluation)
-        agent_builder.add_node(
-            NODE_PYTHON_GENERATION_NAME, self._node_python_execution_sql
-        )
-        agent_builder.add_node(NODE_ANSWER_NAME, self._node_final_answer)
+        nodes = {
+            NODE_GENERATE_NAME: _sync_async_node(
+                self._node_generate_sql, self._anode_generate_sql
+            ),
+            NODE_TOOLS_NAME: ToolNode(self.data_tools),
+            NODE_PYTHON_INTERPRETER_NAME: ToolNode([python_interpreter]),
+            NODE_POST_TOOL_NAME: self._node_post_data_tool,
+            NODE_PYTHON_POST_TOOL_NAME: self._node_post_python_tool,
+            NODE_PYTHON_GENERATION_NAME: _sync_async_node(
+                self._node_python_execution_sql, self._anode_python_execution_sql
+            ),
+            NODE_ANSWER_NAME: _sync_async_node(
+                self._node_final_answer, self._anode_final_answer
+            ),
+        }
+        if self.metadata_prefetch:
+            nodes[NODE_PREFETCH_NAME] = self._node_metadata_prefetch
+        if not self.inline_sufficiency:
+            nodes[NODE_SUFFEVAL_NAME] = _sync_async_node(
+                self._node_sufficiency_evaluation,
+                self._anode_sufficiency_evaluation,
+            )
+        for name, node in nodes.items():
+            agent_builder.add_node(name, _timed_node(name, node))
         # Add edges to connect nodes
-        agent_builder.add_edge(START, NODE_GENERATE_NAME)
+        if self.metadata_prefetch:
+            agent_builder.add_edge(START, NODE_PREFETCH_NAME)
+            agent_builder.add_edge(NODE_PREFETCH_NAME, NODE_GENERATE_NAME)
+        else:
+            agent_builder.add_edge(START, NODE_GENERATE_NAME)
         agent_builder.add_conditional_edges(
             NODE_GENERATE_NAME,
             self._edge_skip_execution,
-            [NODE_TOOLS_NAME, NODE_PYTHON_GENERATION_NAME],
+            [NODE_TOOLS_NAME, NODE_ANSWER_NAME, NODE_PYTHON_GENERATION_NAME],
         )
         agent_builder.add_edge(NODE_TOOLS_NAME, NODE_POST_TOOL_NAME)
-        agent_builder.add_edge(NODE_POST_TOOL_NAME, NODE_SUFFEVAL_NAME)
+        post_tool_destinations = [NODE_GENERATE_NAME, NODE_PYTHON_GENERATION_NAME]
+        if not self.inline_sufficiency:
+            post_tool_destinations.append(NODE_SUFFEVAL_NAME)
+            agent_builder.add_conditional_edges(
+                NODE_SUFFEVAL_NAME,
+                self._edge_sufficiency_evaluation,
+                [NODE_GENERATE_NAME, NODE_PYTHON_GENERATION_NAME],
+            )
         agent_builder.add_conditional_edges(
-            NODE_SUFFEVAL_NAME,
-            self._edge_sufficiency_evaluation,
-            [NODE_GENERATE_NAME, NODE_PYTHON_GENERATION_NAME],
+            NODE_POST_TOOL_NAME, self._edge_after_data_tool, post_tool_destinations
         )
         agent_builder.add_edge(
             NODE_PYTHON_GENERATION_NAME, NODE_PYTHON_INTERPRETER_NAME
@@ -83,26 +195,187 @@ class Text2SqlAgent:
         )
         agent_builder.add_edge(NODE_ANSWER_NAME, END)
 
-        self.graph: CompiledStateGraph = agent_builder.compile()
+        self.graph: CompiledStateGraph = agent_builder.compile(
+            checkpointer=self.checkpointer
+        )
 
-    def invoke(self, message: str):
-        messages = self.graph.invoke({"messages": [HumanMessage(content=message)]})
+    def invoke(self, message: str, session_id: str | None = None):
+        """Answers `message`. Questions with the same `session_id` share the metadata,
+        query results and python output fetched by the previous ones"""
+        thread = self._thread_config(session_id)
+        with trace(message) as current:
+            try:
+                previous = self.graph.get_state(thread).values if thread else {}
+                messages = self.graph.invoke(
+                    turn_input(
+                        previous, message, self.session_max_results, self.session_ttl
+                    ),
+                    thread,
+                    # the state is saved once per question, not after every step
+                    durability="exit",
+                )
+            finally:
+                self._record_trace(current)
+                self._end_turn(thread, session_id)
         return content_as_string(messages["messages"][-1])
 
+    async def ainvoke(self, message: str, session_id: str | None = None):
+        """Async version of `invoke`, many questions can run concurrently on the same event loop"""
+        thread = self._thread_config(session_id)
+        with trace(message) as current:
+            try:
+                previous = (
+                    (await self.graph.aget_state(thread)).values if thread else {}
+                )
+                messages = await self.graph.ainvoke(
+                    turn_input(
+                        previous, message, self.session_max_results, self.session_ttl
+                    ),
+                    thread,
+                    durability="exit",
+                )
+            finally:
+                self._record_trace(current)
+                self._end_turn(thread, session_id)
+        return content_as_string(messages["messages"][-1])
+
+    def stream(self, message: str, session_id: str | None = None) -> Iterator[dict]:
+        """Answers `message` like `invoke`, yielding events as the graph runs: progress
+        ones (node entered, query running, rows fetched), the answer tokens as the model
+        writes them and last the whole answer. Every event is a dict with an `event` key
+        """
+        thread = self._thread_config(session_id)
+        answer_streamed = False
+        final_state = {}
+        with trace(message) as current:
+            try:
+                previous = self.graph.get_state(thread).values if thread else {}
+                for mode, chunk in self.graph.stream(
+                    turn_input(
+                        previous, message, self.session_max_results, self.session_ttl
+                    ),
+                    thread,
+                    stream_mode=STREAM_MODES,
+                    durability="exit",
+                ):
+                    if mode == "values":
+                        final_state = chunk
+                        continue
+                    event = _stream_event(mode, chunk)
+                    if event is not None:
+                        answer_streamed |= event["event"] == ANSWER_TOKEN
+                        yield event
+            finally:
+                self._record_trace(current)
+                self._end_turn(thread, session_id)
+        yield from _answer_events(final_state, answer_streamed)
+
+    async def astream(
+        self, message: str, session_id: str | None = None
+    ) -> AsyncIterator[dict]:
+        """Async version of `stream`"""
+        thread = self._thread_config(session_id)
+        answer_streamed = False
+        final_state = {}
+        with trace(message) as current:
+            try:
+                previous = (
+                    (await self.graph.aget_state(thread)).values if thread else {}
+                )
+                async for mode, chunk in self.graph.astream(
+                    turn_input(
+                        previous, message, self.session_max_results, self.session_ttl
+                    ),
+                    thread,
+                    stream_mode=STREAM_MODES,
+                    durability="exit",
+                ):
+                    if mode == "values":
+                        final_state = chunk
+                        continue
+                    event = _stream_event(mode, chunk)
+                    if event is not None:
+                        answer_streamed |= event["event"] == ANSWER_TOKEN
+                        yield event
+            finally:
+                self._record_trace(current)
+                self._end_turn(thread, session_id)
+        for event in _answer_events(final_state, answer_streamed):
+            yield event
+
+    def _thread_config(self, session_id: str | None) -> RunnableConfig | None:
+        if self.checkpointer is None:
+            return None
+        # questions outside of a session still need a thread, dropped once answered
+        thread_id = session_id or f"oneshot-{uuid.uuid4().hex}"
+        return {"configurable": {"thread_id": thread_id}}
+
+    def _end_turn(self, thread: RunnableConfig | None, session_id: str | None) -> None:
+        if thread is None:
+            return
+        thread_id = thread["configurable"]["thread_id"]
+        if session_id is None:
+            self.checkpointer.delete_thread(thread_id)  # type:ignore
+            return
+        try:
+            # only the latest state of a session is ever resumed
+            self.checkpointer.prune([thread_id])  # type:ignore
+        except NotImplementedError:
+            pass
+
+    def _record_trace(self, current: Trace) -> None:
+        self.last_trace = current
+        record(
+            GRAPH,
+            "invoke",
+            time.perf_counter() - current.start,
+            {
+                # generate -> evaluate loops and python retries of the question
+                "generation_loops": current.visits(NODE_GENERATE_NAME),
+                "context_evaluations": current.visits(NODE_SUFFEVAL_NAME),
+                "python_generations": current.visits(NODE_PYTHON_GENERATION_NAME),
+            },
+        )
+        if self.metrics_path is not None:
+            export_metrics(self.metrics_path)
+
     def _node_generate_sql(self, state: MessagesState):
+        return _unique_result_names(
+            retryable_generation(state, **self._generate_sql_args(state))
+        )
+
+    async def _anode_generate_sql(self, state: MessagesState):
+        return _unique_result_names(
+            await aretryable_generation(state, **self._generate_sql_args(state))
+        )
+
+    def _generate_sql_args(self, state: MessagesState) -> dict:
         logger.debug("node: main control node")
 
         user_query = get_user_question(state)
-        metadata = state.get("metadata", "No metadata fetched yet")
-        data = state.get("fetched_data", "No rows fetched yet")
+        context = self._prompt_context(
+            NODE_GENERATE_NAME,
+            self.local_prompts.sql_generation,
+            state,
+            # the tables to query matter more than the rows already fetched
+            priorities={"metadata": 2, "data": 1},
+        )
         system_prompt = self.local_prompts.sql_generation.format(
-            metadata=metadata,
-            data=data,
+            **context,
             db_kind="BigQuery",
         )
-        llm = self.llm.bind_tools([execute_sql, fetch_metadata])
-        return retryable_generation(
-            state,
+        if self.inline_sufficiency:
+            system_prompt += "\n" + self.local_prompts.inline_sufficiency
+        tools = self.data_tools
+        metadata = state.get("metadata")
+        if metadata and metadata_is_complete(metadata):
+            # the whole schema is already in the prompt
+            tools = [tool for tool in tools if tool is not fetch_metadata]
+        elif metadata:
+            # retrieved for the question, other tables can still be looked up
+            system_prompt += "\n" + self.local_prompts.partial_metadata
+        llm = self.llm.bind_tools(tools)
+        return dict(
             llm_with_tools=llm,
             system_prompt=system_prompt,
             max_retries=self.max_retries,
@@ -112,17 +385,26 @@ class Text2SqlAgent:
         )
 
     def _node_python_execution_sql(self, state: MessagesState):
+        return retryable_generation(state, **self._python_generation_args(state))
+
+    async def _anode_python_execution_sql(self, state: MessagesState):
+        return await aretryable_generation(state, **self._python_generation_args(state))
+
+    def _python_generation_args(self, state: MessagesState) -> dict:
         logger.debug("node: python execution node")
         llm = self.llm.bind_tools([python_interpreter])
         user_query = get_user_question(state)
-        data = state.get("fetched_data", "No data fetched")
-        python_output = state.get("python_output", "No previous python executions")
+        context = self._prompt_context(
+            NODE_PYTHON_GENERATION_NAME,
+            self.local_prompts.python_opt_generation,
+            state,
+            priorities={"data": 2, "python_output": 1},
+        )
         system_prompt = self.local_prompts.python_opt_generation.format(
-            data=data,
-            python_output=python_output,
+            **context,
+            result_loading=self.result_loading,
         )
-        return retryable_generation(
-            state,
+        return dict(
             llm_with_tools=llm,
             system_prompt=system_prompt,
             max_retries=self.max_retries,
@@ -131,6 +413,17 @@ class Text2SqlAgent:
             detect_error=did_last_python_run_fail,
         )
 
+    def _node_metadata_prefetch(self, state: MessagesState):
+        """Retrieves the metadata for the question before the first generation, so that
+        the model can write SQL right away instead of asking for it"""
+        logger.debug("node: metadata prefetch")
+        question = get_user_question(state)
+        metadata = state.get("metadata")
+        if metadata and metadata_covers(metadata, question):
+            logger.debug("metadata of the session already covers the question")
+            return {}
+        return {"metadata": prefetch_metadata(question)}
+
     def _node_post_data_tool(self, state: MessagesState):
         logger.debug("node: post tool state management")
         retry = 0
@@ -138,10 +431,15 @@ class Text2SqlAgent:
             logger.warning("SQL execution failed, retrying")
             retry = state.get("retry_count", 0) + 1
 
+        # every query of the turn is kept, not only the last one
+        new_results = get_turn_results(state)
+        results = merge_results(state.get("fetched_results"), new_results)
         return {
+            "messages": compact_messages(state, self.message_window),
             "retry_count": retry,
             "metadata": get_fetched_metadata(state),
-            "fetched_data": get_fetched_data(state),
+            "fetched_results": new_results,
+            "fetched_data": format_fetched_data(results),
         }
 
     def _node_post_python_tool(self, state: MessagesState):
@@ -152,73 +450,163 @@ class Text2SqlAgent:
             retry = state.get("retry_count", 0) + 1
 
         return {
+            "messages": compact_messages(state, self.message_window),
             "retry_count": retry,
             "python_output": get_python_output(state),
         }
 
     def _node_final_answer(self, state: MessagesState):
+        response = self.llm.invoke(self._final_answer_messages(state))
+        return {"messages": [response]}
+
+    async def _anode_final_answer(self, state: MessagesState):
+        response = await self.llm.ainvoke(self._final_answer_messages(state))
+        return {"messages": [response]}
+
+    def _final_answer_messages(self, state: MessagesState) -> list:
         logger.debug("node: final answer")
         user_query = get_user_question(state)
-        metadata = state.get("metadata", "No metadata fetched yet")
-        sql_result = state.get("fetched_data", "No rows fetched yet")
-        python_output = state.get("python_output", "No previous python executions")
-
-        if sql_result is None:
+        if state.get("fetched_data") is None:
             logger.debug("Final answer has no SQL data available")
-        if metadata is None:
+        if state.get("metadata") is None:
             logger.debug("Final answer has not metadata available")
-        system_prompt = self.local_prompts.final_answer.format(
-            data=sql_result,
-            metadata=metadata,
-            python_output=python_output,
+        context = self._prompt_context(
+            NODE_ANSWER_NAME,
+            self.local_prompts.final_answer,
+            state,
+            # metadata is stale once data was fetched, it's dropped first
+            priorities={"python_output": 3, "data": 2, "metadata": 1},
         )
-        messages = [("system", system_prompt), ("human", user_query)]
-
-        response = self.llm.invoke(messages)
-        return {"messages": [response]}
+        system_prompt = self.local_prompts.final_answer.format(**context)
+        return [("system", system_prompt), ("human", user_query)]
 
     def _node_sufficiency_evaluation(self, state: MessagesState):
+        response = self.llm.invoke(self._sufficiency_evaluation_messages(state))
+        return _parse_sufficiency_evaluation(response)
+
+    async def _anode_sufficiency_evaluation(self, state: MessagesState):
+        response = await self.llm.ainvoke(self._sufficiency_evaluation_messages(state))
+        return _parse_sufficiency_evaluation(response)
+
+    def _sufficiency_evaluation_messages(self, state: MessagesState) -> list:
         logger.debug("node: context evaluation")
         user_query = get_user_question(state)
-        metadata = state.get("metadata", "No metadata fetched yet")
-        data = state.get("fetched_data", "No rows fetched yet")
-        python_output = state.get("python_output", "No previous python executions")
+        context = self._prompt_context(
+            NODE_SUFFEVAL_NAME,
+            self.local_prompts.evaluate_context,
+            state,
+            priorities={"data": 3, "metadata": 2, "python_output": 1},
+        )
         system_prompt = self.local_prompts.evaluate_context.format(
-            metadata=metadata,
-            data=data,
+            **context,
             user_query=user_query,
-            python_output=python_output,
         )
 
-        response = self.llm.invoke(
-            [
-                # gemini api always wants a system message AND a human message
-                SystemMessage(
-                    content="You are a strict evaluator. Respond only with DATA IS EXAUSTIVE or MISSING DATA."
-                ),
-                HumanMessage(content=system_prompt),
-            ]
+        return [
+            # gemini api always wants a system message AND a human message
+            SystemMessage(
+                content="You are a strict evaluator. Respond only with DATA IS EXAUSTIVE or MISSING DATA."
+            ),
+            HumanMessage(content=system_prompt),
+        ]
+
+    def _prompt_context(
+        self, node: str, template: str, state: MessagesState, priorities: dict
+    ) -> dict[str, str]:
+        """Returns the metadata, data and python output placeholders of `template`
+        listed in `priorities`, cut down to fit the prompt token budget of `node`"""
+        sections = {
+            "metadata": ContextSection(
+                "metadata",
+                state.get("metadata") or "No metadata fetched yet",
+                priorities.get("metadata", 0),
+                shrink_metadata,
+            ),
+            "data": ContextSection(
+                "data",
+                state.get("fetched_data") or "No rows fetched yet",
+                priorities.get("data", 0),
+                shrink_data_preview,
+            ),
+            "python_output": ContextSection(
+                "python_output",
+                state.get("python_output") or "No previous python executions",
+                priorities.get("python_output", 0),
+                truncate_middle,
+            ),
+        }
+        return assemble_context(
+            node,
+            template,
+            # sections missing from the template (e.g. in other languages) take no room
+            [sections[name] for name in priorities if f"{{{name}}}" in template],
+            self.prompt_token_budgets.get(node, self.prompt_token_budget),
+            get_user_question(state),
         )
-        response = content_as_string(response)
-        # TODO "DATA IS EXAUSTIVE" is hard coded here and should be fixed somehow
-        return {"sufficient_context": "DATA IS EXAUSTIVE" in response.upper()}
 
     def _edge_skip_execution(self, state: MessagesState) -> str:
         """Routes to tool sql execution or final answer generation depending on
-        if the model produced a sql query tool call in the previous message"""
+        if the model produced a sql query tool call in the previous message.
+        A lone call to the finish tool goes to the python stage"""
         last_message = state["messages"][-1]
         logger.debug("edge: skip tools to final execution")
 
-        if (
-            hasattr(last_message, "tool_calls")
-            and last_message.tool_calls  # type:ignore
-        ):
+        tool_calls = getattr(last_message, "tool_calls", None) or []
+        finish_calls = [
+            call for call in tool_calls if call["name"] == finish_data_fetching.name
+        ]
+        if tool_calls and len(finish_calls) == len(tool_calls):
+            logger.debug("data fetching finished, proceeding to python")
+            return NODE_PYTHON_GENERATION_NAME
+        elif finish_calls:
+            # the other calls still run, data fetching finishes if they succeed
+            logger.warning(
+                f"{finish_data_fetching.name} called together with other tools, running them first"
+            )
+            return NODE_TOOLS_NAME
+        elif tool_calls:
             logger.debug("going to tool calls")
             return NODE_TOOLS_NAME
         else:
             logger.debug("going to final generation")
             return NODE_ANSWER_NAME
 
+    def _edge_after_data_tool(self, state: MessagesState) -> str:
+        """Skips the sufficiency evaluation when its outcome is certain, otherwise goes
+        to the evaluation node or, when it's inlined, back to the generation node"""
+        logger.debug("edge: after data tools")
+        sufficient = self._known_sufficiency(state)
+        if sufficient is True:
+            logger.debug("data known to be enough, proceeding to python")
+            return NODE_PYTHON_GENERATION_NAME
+        if sufficient is False or self.inline_sufficiency:
+            return NODE_GENERATE_NAME
+        return NODE_SUFFEVAL_NAME
+
+    def _known_sufficiency(self, state: MessagesState) -> bool | None:
+        """Cheap deterministic sufficiency checks, `None` when the model must decide"""
+        if state.get("fetched_data") is None or did_last_sql_run_fail(state):
+            # no rows fetched yet or the last query must be fixed
+            return False
+        if any(
+            msg.type == "tool" and msg.name == finish_data_fetching.name
+            for msg in get_last_tool_turn(state)
+        ):
+            # finish called along with other tools that succeeded
+            return True
+        last_message = state["messages"][-1]
+        if (
+            self.skip_lookup_evaluation
+            and last_message.type == "tool"
+            and last_message.name == execute_sql.name
+        ):
+            question = get_user_question(state)
+            if self.lookup_question.match(
+                question
+            ) and not self.not_lookup_question.search(question):
+                return True
+        return None
+
     def _edge_sufficiency_evaluation(self, state: MessagesState) -> str:
         logger.debug("edge: sufficient context branching")
         if state["sufficient_context"]:
@@ -236,6 +624,57 @@ class Text2SqlAgent:
             return NODE_ANSWER_NAME
 
 
+def _stream_event(mode: str, chunk) -> dict | None:
+    """Event of `Text2SqlAgent.stream` for a chunk of the graph stream, if any"""
+    if mode == "custom":
+        # already emitted as events by `emit_progress`
+        return chunk
+    message, metadata = chunk
+    # only the tokens of the final answer, not tool calls and evaluations
+    if metadata.get("langgraph_node") != NODE_ANSWER_NAME or message.type == "tool":
+        return None
+    text = content_as_string(message)
+    if not text:
+        return None
+    return {"event": ANSWER_TOKEN, "text": text}
+
+
+def _answer_events(final_state: dict, answer_streamed: bool) -> Iterator[dict]:
+    answer = content_as_string(final_state["messages"][-1])
+    if not answer_streamed:
+        # e.g. cached responses or runs where the answer node was skipped
+        yield {"event": ANSWER_TOKEN, "text": answer}
+    yield {"event": ANSWER, "text": answer}
+
+
+def _unique_result_names(update: dict) -> dict:
+    """Renames the result files of the `execute_sql` calls of the generated message
+    sharing a `meaningful_filename`: they would overwrite each other's result"""
+    response = update["messages"][-1]
+    names = set()
+    for call in getattr(response, "tool_calls", None) or []:
+        name = call["args"].get("meaningful_filename")
+        if call["name"] != execute_sql.name or not isinstance(name, str):
+            continue
+        for extension in RESULT_FORMAT_EXTENSIONS.values():
+            name = name.removesuffix(extension)
+        unique, copy = name, 1
+        while unique in names:
+            copy += 1
+            unique = f"{name}_{copy}"
+        names.add(unique)
+        if unique != name:
+            logger.warning(f"Result name {name} requested twice, renamed to {unique}")
+            call["args"] = {**call["args"], "meaningful_filename": unique}
+    return update
+
+
+def _parse_sufficiency_evaluation(response) -> dict:
+    response = content_as_string(response)
+    # TODO "DATA IS EXAUSTIVE" is hard coded here and should be fixed somehow
+    return {"sufficient_context": "DATA IS EXAUSTIVE" in response.upper()}
+
+
 def retryable_generation(
     state: MessagesState,
     llm_with_tools,
@@ -246,28 +685,71 @@ def retryable_generation(
     detect_error: Callable[[MessagesState], bool],
 ):
     """Reusable function that implements a node with a retryable tool call."""
+    messages = _retryable_messages(
+        state, system_prompt, user_query, retry_prompt, max_retries, detect_error
+    )
+    if messages is None:
+        return _retries_exhausted_update()
+
+    response = llm_with_tools.invoke(messages)
+    return {
+        "messages": [response],
+    }
+
 
+async def aretryable_generation(
+    state: MessagesState,
+    llm_with_tools,
+    system_prompt: str,
+    user_query: str,
+    retry_prompt: str,
+    max_retries: int,
+    detect_error: Callable[[MessagesState], bool],
+):
+    """Async version of `retryable_generation`"""
+    messages = _retryable_messages(
+        state, system_prompt, user_query, retry_prompt, max_retries, detect_error
+    )
+    if messages is None:
+        return _retries_exhausted_update()
+
+    response = await llm_with_tools.ainvoke(messages)
+    return {
+        "messages": [response],
+    }
+
+
+def _retries_exhausted_update() -> dict:
+    return {
+        "messages": [
+            HumanMessage(content="Tool usage failed too many times. Skipping")
+        ],
+    }
+
+
+def _retryable_messages(
+    state: MessagesState,
+    system_prompt: str,
+    user_query: str,
+    retry_prompt: str,
+    max_retries: int,
+    detect_error: Callable[[MessagesState], bool],
+) -> list | None:
+    """Builds the generation prompt, including the failed attempt if the last tool
+    call failed. Returns `None` if too many retries were done already"""
     if state.get("retry_count", 0) > max_retries:
         logger.error("Tool usage failed too many times. Skipping")
-        return {
-            "messages": [
-                HumanMessage(content="Tool usage failed too many times. Skipping")
-            ],
-        }
+        return None
 
     messages = [
         SystemMessage(content=system_prompt),
         HumanMessage(content=user_query),
     ]
     if detect_error(state):
-        # add to context the failed generated code
-        messages.append(state["messages"][-2])
-        # add to context the error message
-        tool_error_msg = state["messages"][-1]
-        messages.append(tool_error_msg)
+        increment("retries")
+        # add to context the failed generated code and the error messages, along with
+        # the other tool calls of the same turn that must be answered too
+        messages.extend(get_last_tool_turn(state))
         messages.append(HumanMessage(content=retry_prompt))
 
-    response = llm_with_tools.invoke(messages)
-    return {
-        "messages": [response],
-    }
+    return messages
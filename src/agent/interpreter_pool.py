@@ -0,0 +1,218 @@
+import atexit
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import threading
+import traceback
+from src.logger import logger
+
+
+# imported by workers before receiving any script
+PRELOADED_MODULES = ["numpy", "pandas", "matplotlib", "matplotlib.pyplot"]
+
+
+class InterpreterPool:
+    """Pool of warm Python processes running scripts as `python script.py` would,
+    with data science libraries already imported. Every script runs in a fresh namespace,
+    workers are replaced after `max_runs` scripts, when they crash or time out"""
+
+    def __init__(self, size: int, max_runs: int):
+        self.size = size
+        self.max_runs = max_runs
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: queue.Queue[_Worker] = queue.Queue()
+        self._workers: set[_Worker] = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(size):
+            self._idle.put(self._start_worker())
+        atexit.register(self.close)
+
+    def run(
+        self, script_path: str, timeout: float, results_directory: str | None = None
+    ) -> tuple[int, str, str]:
+        """Runs the script at `script_path` returning its exit code, stdout and stderr.
+        Scripts can read query results in `results_directory` with `load_result(name)`.
+        Raises `TimeoutError` if it doesn't complete within `timeout` seconds"""
+        if results_directory is not None:
+            results_directory = os.path.abspath(results_directory)
+        worker = self._idle.get()
+        try:
+            worker.conn.send(
+                (os.path.abspath(script_path), os.getcwd(), results_directory)
+            )
+            # also returns when the worker dies, then recv raises EOFError
+            finished = worker.conn.poll(timeout)
+            if finished:
+                returncode, stdout, stderr = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            self._replace(worker)
+            return 1, "", f"Python interpreter process crashed: {e!r}"
+
+        if not finished:
+            self._replace(worker)
+            raise TimeoutError(f"Script didn't complete in {timeout} seconds")
+
+        worker.runs += 1
+        if worker.runs >= self.max_runs:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+        return returncode, stdout, stderr
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def _start_worker(self) -> "_Worker":
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn,), name="python-interpreter"
+        )
+        process.start()
+        child_conn.close()
+        worker = _Worker(process, parent_conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker: "_Worker") -> None:
+        with self._lock:
+            self._workers.discard(worker)
+        worker.stop()
+        if not self._closed:
+            logger.debug("Starting a new python interpreter worker")
+            self._idle.put(self._start_worker())
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.runs = 0
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+def _worker_main(conn) -> None:
+    """Worker process loop: receives script paths and sends back their results"""
+    import matplotlib
+
+    # no display is available and figures must be saved to files anyway
+    matplotlib.use("Agg")
+    for module in PRELOADED_MODULES:
+        __import__(module)
+
+    base_path = list(sys.path)
+    while True:
+        try:
+            script_path, cwd, results_directory = conn.recv()
+        except EOFError:
+            return
+        conn.send(_run_script(script_path, cwd, base_path, results_directory))
+
+
+# arrow tables of the results already loaded by this worker, by path
+_loaded_results: dict[str, tuple[tuple[int, int], object]] = {}
+
+
+def load_result(name: str, directory: str, arrow: bool = False):
+    """Loads the query result `name` (with or without extension) from `directory`
+    as a pandas DataFrame, or as a pyarrow Table if `arrow` is set.
+    Arrow IPC files are memory-mapped: columns are read straight from the page cache
+    that the file was written to, without parsing nor copying the data.
+    Tables are cached until the file changes"""
+    import pandas as pd
+    import pyarrow as pa
+
+    path = os.path.join(directory, os.path.basename(name))
+    if not os.path.splitext(path)[1]:
+        for extension in (".arrow", ".parquet", ".csv"):
+            if os.path.exists(path + extension):
+                path += extension
+                break
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _loaded_results.get(path)
+    if cached is not None and cached[0] == version:
+        table = cached[1]
+    else:
+        if path.endswith(".arrow"):
+            # files are replaced, never rewritten in place, so the mapping stays valid
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        elif path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            table = pq.read_table(path, memory_map=True)
+        else:
+            import pyarrow.csv
+
+            table = pa.csv.read_csv(path)
+        _loaded_results[path] = (version, table)
+
+    if arrow:
+        return table
+    # arrow backed columns avoid converting the data to numpy where possible
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _run_script(
+    script_path: str,
+    cwd: str,
+    base_path: list[str],
+    results_directory: str | None = None,
+) -> tuple:
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    returncode = 0
+    os.chdir(cwd)
+    sys.argv = [script_path]
+    sys.path[:] = [os.path.dirname(script_path)] + base_path
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            # fresh module namespace for every script
+            runpy.run_path(
+                script_path,
+                init_globals=_script_globals(results_directory),
+                run_name="__main__",
+            )
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                returncode = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            import matplotlib.pyplot as plt
+
+            plt.close("all")
+
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+
+def _script_globals(results_directory: str | None) -> dict:
+    if results_directory is None:
+        return {}
+
+    def load_result_from_directory(name: str, arrow: bool = False):
+        return load_result(name, results_directory, arrow)
+
+    load_result_from_directory.__doc__ = load_result.__doc__
+    return {"load_result": load_result_from_directory}
@@ -1,28 +1,53 @@
-from collections.abc import Sequence
+from collections.abc import AsyncIterator, Iterator, Sequence
 from datetime import datetime
+import hashlib
+import itertools
+import json
+import os
 from langchain_core.prompt_values import PromptValue
 from langchain_core.language_models import BaseChatModel
 from langchain_core.language_models.base import LanguageModelInput
-from langchain_core.messages import AIMessage, BaseMessage
-from langchain_core.runnables import RunnableConfig
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    message_chunk_to_message,
+)
+from langchain_core.runnables import RunnableConfig, ensure_config
 from langchain_google_genai import ChatGoogleGenerativeAI
 import threading
+import time
 from typing import Any
+import uuid
+from src.cache import CACHE_DIRECTORY, SqliteCache
 from src.config import Config
+from src.logger import LLM_CALL_KEY, logger
+from src.metrics import LLM, record as record_span
 
 
 _lock = threading.Lock()
+# numbers calls across every model of the process
+_call_counter = itertools.count(1)
+# records are written to the LLM calls trail by the background logging thread
+_call_logger = logger.bind(**{LLM_CALL_KEY: True})
+# shared by every model instantiated in this process
+_response_cache: SqliteCache | None = None
 
 
 # BaseChatModel is abstract and requires implementing _generate
 # for the time being im only extending ChatGoogleGenerativeAI
 class LoggedChatModel(ChatGoogleGenerativeAI):
-    def __init__(self, inner_llm: BaseChatModel):
+    def __init__(
+        self,
+        inner_llm: BaseChatModel,
+        response_cache: SqliteCache | None = None,
+        cache_namespace: str = "",
+    ):
         self._inner_llm = inner_llm
-        self._log_path = "./logs/llm_calls.log"
-        self._call_index = 0
-        with open(self._log_path, "w", encoding="utf-8") as f:
-            f.write("Last execution LLM convo trail\n")
+        # exact match cache of responses, keys are prefixed by `cache_namespace`
+        # which must identify the model and its settings
+        self._response_cache = response_cache
+        self._cache_namespace = cache_namespace
 
     @property
     def _llm_type(self) -> str:
@@ -56,33 +81,51 @@ class LoggedChatModel(ChatGoogleGenerativeAI):
         stop: list[str] | None = None,
         **kwargs: Any,
     ) -> AIMessage:
-        messages = input
-        with _lock:
-            self._call_index += 1
-            call_number = self._call_index
-
-        record = {
-            "call_number": call_number,
-            "timestamp": datetime.now().isoformat(),
-            "prompt": self._prompt_from_messages(messages),
-            "stop": stop,
-            "config": config,
-            "kwargs": kwargs,
-        }
+        record = self._new_record(input, config, stop, kwargs)
+        cache_key = self._cache_key(input, stop, kwargs)
         try:
+            cached = self._cached_response(cache_key, record)
+            if cached is not None:
+                return cached
             response = self._inner_llm.invoke(
                 input,
                 config=config,
                 stop=stop,
                 **kwargs,
             )
+            self._record_response(record, response)
+            self._cache_response(cache_key, response)
+            return response
 
-            record["response"] = {
-                "type": response.type,
-                "content": response.content,
-                "additional_kwargs": response.additional_kwargs,
-            }
+        except Exception as e:
+            record["exception"] = repr(e)
+            raise
 
+        finally:
+            self._write_record(record)
+
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: RunnableConfig | None = None,
+        *,
+        stop: list[str] | None = None,
+        **kwargs: Any,
+    ) -> AIMessage:
+        record = self._new_record(input, config, stop, kwargs)
+        cache_key = self._cache_key(input, stop, kwargs)
+        try:
+            cached = self._cached_response(cache_key, record)
+            if cached is not None:
+                return cached
+            response = await self._inner_llm.ainvoke(
+                input,
+                config=config,
+                stop=stop,
+                **kwargs,
+            )
+            self._record_response(record, response)
+            self._cache_response(cache_key, response)
             return response
 
         except Exception as e:
@@ -92,18 +135,235 @@ class LoggedChatModel(ChatGoogleGenerativeAI):
         finally:
             self._write_record(record)
 
+    def stream(
+        self,
+        input: LanguageModelInput,
+        config: RunnableConfig | None = None,
+        *,
+        stop: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Iterator[AIMessageChunk]:
+        """Yields the response chunks of the inner model, the call is logged once the
+        stream completes with the whole response"""
+        record = self._new_record(input, config, stop, kwargs)
+        cache_key = self._cache_key(input, stop, kwargs)
+        try:
+            cached = self._cached_response(cache_key, record)
+            if cached is not None:
+                yield _as_chunk(cached)
+                return
+            response = None
+            for chunk in self._inner_llm.stream(
+                input,
+                config=config,
+                stop=stop,
+                **kwargs,
+            ):
+                response = self._add_chunk(record, response, chunk)
+                yield chunk
+            self._stream_completed(record, cache_key, response)
+
+        except GeneratorExit:
+            # the caller stopped reading the stream
+            record["interrupted"] = True
+            raise
+
+        except Exception as e:
+            record["exception"] = repr(e)
+            raise
+
+        finally:
+            self._write_record(record)
+
+    async def astream(
+        self,
+        input: LanguageModelInput,
+        config: RunnableConfig | None = None,
+        *,
+        stop: list[str] | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[AIMessageChunk]:
+        record = self._new_record(input, config, stop, kwargs)
+        cache_key = self._cache_key(input, stop, kwargs)
+        try:
+            cached = self._cached_response(cache_key, record)
+            if cached is not None:
+                yield _as_chunk(cached)
+                return
+            response = None
+            async for chunk in self._inner_llm.astream(
+                input,
+                config=config,
+                stop=stop,
+                **kwargs,
+            ):
+                response = self._add_chunk(record, response, chunk)
+                yield chunk
+            self._stream_completed(record, cache_key, response)
+
+        except GeneratorExit:
+            record["interrupted"] = True
+            raise
+
+        except Exception as e:
+            record["exception"] = repr(e)
+            raise
+
+        finally:
+            self._write_record(record)
+
+    def _add_chunk(
+        self,
+        record: dict,
+        response: AIMessageChunk | None,
+        chunk: AIMessageChunk,
+    ) -> AIMessageChunk:
+        if response is None:
+            record["first_token_ms"] = round(
+                (time.perf_counter() - record["start"]) * 1000
+            )
+            return chunk
+        return response + chunk
+
+    def _stream_completed(
+        self, record: dict, cache_key: str | None, response: AIMessageChunk | None
+    ) -> None:
+        message = message_chunk_to_message(response or AIMessageChunk(content=""))
+        self._record_response(record, message)
+        self._cache_response(cache_key, message)
+
+    def cache_stats(self) -> dict | None:
+        """Hit/miss counters and size of the response cache, `None` if disabled"""
+        if self._response_cache is None:
+            return None
+        return self._response_cache.stats()
+
+    def _cache_key(
+        self, messages: LanguageModelInput, stop: list[str] | None, kwargs: dict
+    ) -> str | None:
+        if self._response_cache is None:
+            return None
+
+        serialized_messages = []
+        for message in self._inner_llm._convert_input(messages).to_messages():
+            # tool call ids are random, they don't identify the conversation
+            serialized_messages.append(
+                {
+                    "type": message.type,
+                    "content": message.content,
+                    "name": message.name,
+                    "tool_calls": [
+                        {"name": call["name"], "args": call["args"]}
+                        for call in getattr(message, "tool_calls", [])
+                    ],
+                }
+            )
+        # bound tools are part of the kwargs
+        serialized = json.dumps(
+            {"messages": serialized_messages, "stop": stop, "kwargs": kwargs},
+            sort_keys=True,
+            default=str,
+        )
+        digest = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+        return f"{self._cache_namespace}:{digest}"
+
+    def _cached_response(self, cache_key: str | None, record: dict) -> AIMessage | None:
+        # keys are only computed when the cache is enabled
+        if cache_key is None or self._response_cache is None:
+            return None
+        response = self._response_cache.get(cache_key)
+        if response is None:
+            return None
+
+        logger.debug(f"LLM response cache hit ({self._response_cache.stats()})")
+        record["cached"] = True
+        self._record_response(record, response)
+        # fresh ids, the same response can be appended more than once to a conversation
+        return response.model_copy(
+            update={
+                "id": f"cached-{uuid.uuid4()}",
+                "tool_calls": [
+                    {**call, "id": str(uuid.uuid4())} for call in response.tool_calls
+                ],
+            }
+        )
+
+    def _cache_response(self, cache_key: str | None, response: AIMessage) -> None:
+        if cache_key is not None and self._response_cache is not None:
+            self._response_cache.set(cache_key, response)
+
+    def _new_record(
+        self,
+        messages: LanguageModelInput,
+        config: RunnableConfig | None,
+        stop: list[str] | None,
+        kwargs: dict,
+    ) -> dict:
+        # the config of the graph run calling the model when not given explicitly
+        config = ensure_config(config)
+        return {
+            "call_number": next(_call_counter),
+            "timestamp": datetime.now().isoformat(),
+            "thread": threading.current_thread().name,
+            "session_id": config.get("configurable", {}).get("thread_id"),
+            "node": config.get("metadata", {}).get("langgraph_node"),
+            "prompt": self._prompt_from_messages(messages),
+            "stop": stop,
+            "tools": [
+                tool.get("function", tool).get("name")
+                for tool in kwargs.get("tools", [])
+                if isinstance(tool, dict)
+            ],
+            "kwargs": {k: v for k, v in kwargs.items() if k != "tools"},
+            "start": time.perf_counter(),
+        }
+
+    def _record_response(self, record: dict, response: BaseMessage):
+        record["response"] = {
+            "type": response.type,
+            "content": response.content,
+            "tool_calls": getattr(response, "tool_calls", []),
+            "additional_kwargs": response.additional_kwargs,
+        }
+        record["usage"] = getattr(response, "usage_metadata", None)
+
     def _write_record(self, record: dict):
-        # print(record)
-        with _lock:
-            with open(self._log_path, "a", encoding="utf-8") as f:
-                f.write("=" * 50 + "\n")
-                f.write(f"Call N {record['call_number']} at {record['timestamp']}\n")
-                f.write("=" * 50 + "\n")
-                f.write(f"{record['prompt']}\n\n")
-                f.write("Model response:\n")
-                f.write(f"{record.get('response',{}).get('content','')}")
-                f.write(f"{record.get('exception', '')}")
-                f.write("\n\n\n\n")
+        seconds = time.perf_counter() - record.pop("start")
+        record["latency_ms"] = round(seconds * 1000)
+        usage = record.get("usage") or {}
+        record_span(
+            LLM,
+            record["node"] or "other",
+            seconds,
+            {
+                "input_tokens": usage.get("input_tokens"),
+                "output_tokens": usage.get("output_tokens"),
+                "cache_hits": int(record.get("cached", False)),
+            },
+            failed="exception" in record,
+        )
+        # only serializes and enqueues the record, the file is written by another thread
+        _call_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def _as_chunk(message: AIMessage) -> AIMessageChunk:
+    """Single chunk streaming the whole `message`"""
+    return AIMessageChunk(
+        content=message.content,
+        id=message.id,
+        additional_kwargs=message.additional_kwargs,
+        response_metadata=message.response_metadata,
+        usage_metadata=message.usage_metadata,
+        tool_call_chunks=[
+            {
+                "name": call["name"],
+                "args": json.dumps(call["args"]),
+                "id": call["id"],
+                "index": i,
+            }
+            for i, call in enumerate(message.tool_calls)
+        ],
+    )
 
 
 def instantiate_llm(config: Config) -> ChatGoogleGenerativeAI:
@@ -112,7 +372,23 @@ def instantiate_llm(config: Config) -> ChatGoogleGenerativeAI:
             model=config.model_name,
             temperature=config.model_settings.temperature,
             project=config.gcp_project,
-        )
+        ),
+        response_cache=_get_response_cache(config),
+        cache_namespace=f"{config.provider}/{config.model_name}/{json.dumps(vars(config.model_settings), sort_keys=True)}",
     )
 
     return model
+
+
+def _get_response_cache(config: Config) -> SqliteCache | None:
+    global _response_cache
+    if not config.llm_cache_enabled:
+        return None
+    with _lock:
+        if _response_cache is None:
+            _response_cache = SqliteCache(
+                os.path.join(CACHE_DIRECTORY, "llm_responses.sqlite"),
+                ttl_seconds=config.llm_cache_ttl,
+                max_bytes=config.llm_cache_max_mb * 1024 * 1024,
+            )
+    return _response_cache
@@ -0,0 +1,22 @@
+from langgraph.config import get_stream_writer
+
+
+# events yielded by `Text2SqlAgent.stream`, besides the answer ones
+NODE_ENTERED = "node_entered"
+QUERY_RUNNING = "query_running"
+ROWS_FETCHED = "rows_fetched"
+# the answer as it's written by the model, then whole once it's done
+ANSWER_TOKEN = "answer_token"
+ANSWER = "answer"
+
+
+def emit_progress(event: str, **data) -> None:
+    """Sends a progress event to the stream of the running graph, does nothing when
+    the graph isn't streamed or outside of a graph run"""
+    try:
+        writer = get_stream_writer()
+    except (RuntimeError, KeyError):
+        # outside of any runnable config, or within one that isn't a graph run,
+        # e.g. a tool invoked directly
+        return
+    writer({"event": event, **data})
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import time
+from langchain.messages import HumanMessage, RemoveMessage
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from src.agent.state import format_fetched_data
+from src.cache import CACHE_DIRECTORY
+from src.config import Config
+from src.logger import logger
+
+
+SESSIONS_PATH = os.path.join(CACHE_DIRECTORY, "sessions.sqlite")
+
+
+def make_checkpointer(config: Config) -> BaseCheckpointSaver | None:
+    """Returns the checkpointer keeping the graph state of every session between
+    questions, `None` if sessions are disabled"""
+    if config.session_checkpointer == "off":
+        return None
+    if config.session_checkpointer == "memory":
+        return InMemorySaver()
+
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+    except ImportError as e:
+        raise ImportError(
+            "session_checkpointer: sqlite requires the langgraph-checkpoint-sqlite package"
+        ) from e
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    return SqliteSaver(sqlite3.connect(SESSIONS_PATH, check_same_thread=False))
+
+
+def turn_input(previous: dict, question: str, max_results: int, ttl: int) -> dict:
+    """Graph input starting a new question of a session whose last saved state is
+    `previous`. Metadata, query results and the python output of earlier questions
+    are kept, per question counters are reset and stale entries evicted"""
+    update = {
+        "messages": [HumanMessage(content=question)],
+        "user_question": question,
+        "retry_count": 0,
+        "sufficient_context": False,
+        "turn_started_at": time.time(),
+    }
+    if not previous:
+        return update
+
+    results = previous.get("fetched_results") or {}
+    last_turn = previous.get("turn_started_at", 0.0)
+    if time.time() - last_turn > ttl:
+        logger.debug("Session expired, starting over")
+        update["messages"].insert(0, RemoveMessage(id=REMOVE_ALL_MESSAGES))
+        update["metadata"] = None
+        update["python_output"] = None
+        evicted = list(results)
+    else:
+        # results deleted from disk can't be loaded anymore, the oldest go first
+        evicted = [path for path in results if not os.path.exists(path)]
+        kept = [path for path in results if path not in evicted]
+        evicted += kept[: max(len(kept) - max_results, 0)]
+
+    if evicted:
+        logger.debug(f"Evicting {len(evicted)} query results from the session")
+        update["fetched_results"] = {path: None for path in evicted}
+        update["fetched_data"] = format_fetched_data(
+            {path: output for path, output in results.items() if path not in evicted}
+        )
+    return update
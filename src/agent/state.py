@@ -1,15 +1,40 @@
 from langchain.messages import (
     AnyMessage,
+    RemoveMessage,
 )
-import operator
+from langgraph.graph.message import add_messages
+import re
 from typing_extensions import TypedDict, Annotated
 from src.agent.tools import *
 from src.utils import content_as_string
 
 
+RESULT_PATH = re.compile(r"^\(The full query result is available at the path (.+?);")
+
+
+def merge_results(left: dict[str, str], right: dict[str, str | None]) -> dict[str, str]:
+    """Reducer of `fetched_results`: a new result for the same file replaces the old one
+    and becomes the newest, a `None` result evicts it"""
+    merged = dict(left or {})
+    for path, output in (right or {}).items():
+        merged.pop(path, None)
+        if output is not None:
+            merged[path] = output
+    return merged
+
+
 class MessagesState(TypedDict):
-    messages: Annotated[list[AnyMessage], operator.add]
+    # only the last `message_window` messages are kept, the outputs needed later
+    # are copied in the slots below by the post tool nodes
+    messages: Annotated[list[AnyMessage], add_messages]
+    # written once when the question is asked
+    user_question: str
+    # when the current question of the session was asked
+    turn_started_at: float
     metadata: str
+    # output of every successful `execute_sql` call, keyed by result file
+    fetched_results: Annotated[dict[str, str], merge_results]
+    # all of `fetched_results` as shown to the model
     fetched_data: str
     retry_count: int
     sufficient_context: bool
@@ -17,37 +42,90 @@ class MessagesState(TypedDict):
 
 
 def did_last_sql_run_fail(state: MessagesState) -> bool:
-    """Returns `True` iff the last message was from the sql execution tool and failed"""
-    last_message = content_as_string(state["messages"][-1])
-    return SQL_EXECUTION_ERROR_PREFIX in last_message
+    """Returns `True` iff any of the sql executions run by the last tool turn failed"""
+    return any(
+        SQL_EXECUTION_ERROR_PREFIX in content_as_string(msg)
+        for msg in _last_turn_tool_messages(state, "execute_sql")
+    )
 
 
 def did_last_python_run_fail(state: MessagesState) -> bool:
-    """Returns `True` iff the last message was from the python execution tool and failed"""
-    last_message = content_as_string(state["messages"][-1])
-    return PYTHON_EXECUTION_ERROR_PREFIX in last_message
+    """Returns `True` iff the last tool turn ran python code that failed"""
+    return any(
+        PYTHON_EXECUTION_ERROR_PREFIX in content_as_string(msg)
+        for msg in _last_turn_tool_messages(state, "python_interpreter")
+    )
 
 
 def get_fetched_metadata(state: MessagesState) -> str | None:
     """Returns the string output of the latest `fetch_metadata` tool if it was run before,
     `None` otherwise"""
-    return _get_tool_output_as_string(state, "fetch_metadata")
+    return _latest_tool_output(state, "fetch_metadata", "metadata")
 
 
-def get_fetched_data(state: MessagesState) -> str | None:
-    """Returns the string output of the latest `execute_sql` tool if it was run before,
-    `None` otherwise"""
-    return _get_tool_output_as_string(state, "execute_sql")
+def get_turn_results(state: MessagesState) -> dict[str, str]:
+    """Returns the outputs of the successful `execute_sql` calls of the last tool turn,
+    keyed by the file the full result was written to"""
+    results = {}
+    for msg in _last_turn_tool_messages(state, "execute_sql"):
+        output = content_as_string(msg)
+        match = RESULT_PATH.match(output)
+        if match is not None:
+            results[match.group(1)] = output
+    return results
+
+
+def format_fetched_data(results: dict[str, str]) -> str | None:
+    """Joins the outputs of all fetched results, `None` if there are none"""
+    if not results:
+        return None
+    return "\n".join(results.values())
 
 
 def get_python_output(state: MessagesState) -> str | None:
     """Returns the string collected from std output of the latest execution of python code
     by the `python_interpreter` tool if it was run before, `None` otherwise"""
-    return _get_tool_output_as_string(state, "python_interpreter")
+    return _latest_tool_output(state, "python_interpreter", "python_output")
 
 
-def _get_tool_output_as_string(state: MessagesState, tool_name: str) -> str | None:
+def get_last_tool_turn(state: MessagesState) -> list:
+    """Returns the last AI message requesting tool calls followed by the tool messages
+    answering them"""
+    messages = state["messages"]
+    start = len(messages)
+    while start > 0 and messages[start - 1].type == "tool":
+        start -= 1
+    return messages[max(start - 1, 0) :]
+
+
+def compact_messages(state: MessagesState, window: int) -> list[RemoveMessage]:
+    """Returns the removals dropping every message but the last `window` ones, without
+    splitting a tool turn. A `window` of 0 keeps all of them"""
+    messages = state["messages"]
+    if window <= 0 or len(messages) <= window:
+        return []
+    start = len(messages) - window
+    # the kept messages start with the AI message requesting the tool calls
+    while start > 0 and messages[start].type == "tool":
+        start -= 1
+    return [RemoveMessage(id=msg.id) for msg in messages[:start]]
+
+
+def _last_turn_tool_messages(state: MessagesState, tool_name: str) -> list:
+    """Tool messages named `tool_name` answering the tool calls of the last AI message"""
+    messages = []
     for msg in reversed(state["messages"]):
-        if msg.type == "tool" and msg.name == tool_name:
-            return content_as_string(msg)
-    return None
+        if msg.type != "tool":
+            break
+        if msg.name == tool_name:
+            messages.append(msg)
+    messages.reverse()
+    return messages
+
+
+def _latest_tool_output(state: MessagesState, tool_name: str, slot: str) -> str | None:
+    # outputs of older turns were already copied in `slot` by the post tool nodes
+    messages = _last_turn_tool_messages(state, tool_name)
+    if messages:
+        return content_as_string(messages[-1])
+    return state.get(slot)
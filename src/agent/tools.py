@@ -1,106 +1,426 @@
+import asyncio
 import csv
+import json
 from langchain.messages import (
     SystemMessage,
     HumanMessage,
 )
 from langchain.tools import tool
+from langchain_core.tools import StructuredTool
+import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import threading
+from src.agent.interpreter_pool import InterpreterPool
 from src.agent.llm_backend import instantiate_llm
-from src.config import read_config
-from src.db import run_sql_query, get_table_metadata
+from src.agent.progress import QUERY_RUNNING, ROWS_FETCHED, emit_progress
+from src.catalog import get_catalog
+from src.config import Config, read_config
+from src.db import (
+    QueryResult,
+    arrow_schema,
+    arun_sql_query,
+    run_sql_query,
+    get_table_metadata,
+)
 from src.prompts.en import metadata_extraction
+from src.retrieval import search_tables
 from src.logger import logger
+from src.metrics import TOOL, increment, span
 from src.utils import content_as_string
 
 
 SQL_EXECUTION_ERROR_PREFIX = "SQL execution error:"
 PYTHON_EXECUTION_ERROR_PREFIX = "Python execution error"
 QUERY_RESULT_DIRECTORY = "./query_results"
-os.makedirs(QUERY_RESULT_DIRECTORY, exist_ok=True)
+GENERATED_CODE_DIRECTORY = "generated_code"
+RESULT_FORMAT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+# async calls waiting for a free query slot check again after this delay
+QUERY_SLOT_POLL_SECONDS = 0.05
 
+_config: Config | None = None
+_interpreter_pool: InterpreterPool | None = None
+_interpreter_pool_lock = threading.Lock()
+# bounds the BigQuery jobs run at once by concurrent tool calls
+_query_slots: threading.BoundedSemaphore | None = None
+_query_slots_lock = threading.Lock()
 
-@tool
-def execute_sql(query: str, meaningful_filename: str) -> str:
+
+def configure_tools(config: Config) -> None:
+    """Sets the config used by tools, otherwise it's read from `./config.yml` on first use"""
+    global _config, _query_slots
+    _config = config
+    _query_slots = None
+
+
+def use_output_subdirectory(name: str) -> None:
+    """Makes tools of this process write query results and generated code in a `name`
+    subdirectory, so that concurrent processes never write to the same files"""
+    global QUERY_RESULT_DIRECTORY, GENERATED_CODE_DIRECTORY
+    QUERY_RESULT_DIRECTORY = os.path.join(QUERY_RESULT_DIRECTORY, name)
+    GENERATED_CODE_DIRECTORY = os.path.join(GENERATED_CODE_DIRECTORY, name)
+    os.makedirs(QUERY_RESULT_DIRECTORY, exist_ok=True)
+
+
+def _get_config() -> Config:
+    global _config
+    if _config is None:
+        _config = read_config("./config.yml")
+    return _config
+
+
+def _execute_sql(query: str, meaningful_filename: str) -> str:
     """Execute the SQL `query` against the database and return results.
     If the query fails, returns an error message that should be used to fix and retry the query.
-    Requires also `meaningful_filename` the file name that will be used to store the result as a csv file
+    Requires also `meaningful_filename` the file name that will be used to store the full result
     """
 
+    with span(TOOL, "execute_sql"):
+        try:
+            logger.debug("tool: execute sql")
+            config = _get_config()
+            save_code(query, extension="sql", custom_name=meaningful_filename)
+            with _get_query_slots():
+                emit_progress(QUERY_RUNNING, query=query, filename=meaningful_filename)
+                result = run_sql_query(query, page_size=config.query_page_size)
+                _count_query(result)
+                return _store_result(result, meaningful_filename, config)
+        except Exception as e:
+            increment("failures")
+            return f"{SQL_EXECUTION_ERROR_PREFIX} {str(e)}"
+
+
+async def _aexecute_sql(query: str, meaningful_filename: str) -> str:
+    with span(TOOL, "execute_sql"):
+        try:
+            logger.debug("tool: execute sql (async)")
+            config = _get_config()
+            save_code(query, extension="sql", custom_name=meaningful_filename)
+            query_slots = _get_query_slots()
+            acquired = False
+            try:
+                # the semaphore is shared with sync callers. It's polled: waiting for it
+                # in a thread would take the executor threads that the calls holding
+                # a slot need to complete
+                while not query_slots.acquire(blocking=False):
+                    await asyncio.sleep(QUERY_SLOT_POLL_SECONDS)
+                acquired = True
+                emit_progress(QUERY_RUNNING, query=query, filename=meaningful_filename)
+                result = await arun_sql_query(query, page_size=config.query_page_size)
+                _count_query(result)
+                # fetching pages is blocking I/O
+                return await asyncio.to_thread(
+                    _store_result, result, meaningful_filename, config
+                )
+            finally:
+                if acquired:
+                    query_slots.release()
+        except Exception as e:
+            increment("failures")
+            return f"{SQL_EXECUTION_ERROR_PREFIX} {str(e)}"
+
+
+def _get_query_slots() -> threading.BoundedSemaphore:
+    global _query_slots
+    with _query_slots_lock:
+        if _query_slots is None:
+            _query_slots = threading.BoundedSemaphore(
+                max(_get_config().max_concurrent_queries, 1)
+            )
+        return _query_slots
+
+
+def _count_query(result: QueryResult) -> None:
+    increment("bytes_processed", result.bytes_processed or 0)
+    increment("cache_hits", int(result.from_cache))
+
+
+execute_sql = StructuredTool.from_function(
+    func=_execute_sql, coroutine=_aexecute_sql, name="execute_sql"
+)
+
+
+def _store_result(result: QueryResult, meaningful_filename: str, config: Config) -> str:
+    """Writes the full `result` to the results directory and returns the tool output
+    with the result path, a preview of the rows and some fetch statistics"""
+    column_names = [col.name for col in result.schema]
+    extension = RESULT_FORMAT_EXTENSIONS[config.query_result_format]
+    for known_extension in RESULT_FORMAT_EXTENSIONS.values():
+        meaningful_filename = meaningful_filename.removesuffix(known_extension)
+    os.makedirs(QUERY_RESULT_DIRECTORY, exist_ok=True)
+    result_path = f"{QUERY_RESULT_DIRECTORY}/{meaningful_filename}{extension}"
+
+    if config.query_result_format == "csv":
+        preview, rows_fetched, bytes_written = _write_csv(
+            result_path, result, column_names, config.query_preview_rows
+        )
+    else:
+        csv_export_path = None
+        if config.query_result_csv_export:
+            csv_export_path = f"{QUERY_RESULT_DIRECTORY}/{meaningful_filename}.csv"
+        preview, rows_fetched, bytes_written = _write_columnar(
+            result_path,
+            result,
+            config.query_preview_rows,
+            config.query_result_format,
+            csv_export_path,
+        )
+
+    header = "\t".join(column_names)
+    values = ""
+    for row in preview:
+        values += "\t".join([str(cell) for cell in row])
+        values += "\n"
+    stats = f"{rows_fetched} rows fetched, {bytes_written} bytes written"
+    peak_rss = _process_peak_rss_mb()
+    if peak_rss is not None:
+        # since the process started, not of this query alone
+        stats += f", process peak RSS {peak_rss:.0f} MB"
+    logger.debug(f"query result: {stats}")
+    emit_progress(ROWS_FETCHED, path=result_path, rows=rows_fetched)
+    return f"(The full query result is available at the path {result_path}; {stats})\n{header}\n{values}"
+
+
+def _write_csv(
+    path: str, result: QueryResult, column_names: list[str], preview_rows: int
+) -> tuple[list, int, int]:
+    """Writes the result pages to a csv file as they are fetched.
+    Returns the preview rows, the number of rows and of bytes written"""
+    preview = []
+    rows_fetched = 0
+    with open(path, mode="w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(column_names)
+        # only one page of rows is held in memory at any time
+        for page in result.pages:
+            if len(preview) < preview_rows:
+                preview += page[: preview_rows - len(preview)]
+            writer.writerows(page)  # type:ignore
+            rows_fetched += len(page)
+        bytes_written = csvfile.tell()
+
+    return preview, rows_fetched, bytes_written
+
+
+def _write_columnar(
+    path: str,
+    result: QueryResult,
+    preview_rows: int,
+    result_format: str,
+    csv_export_path: str | None = None,
+) -> tuple[list, int, int]:
+    """Like `_write_csv` but streams the result arrow record batches to a
+    parquet or arrow IPC file, keeping the BigQuery column types.
+    The same batches can also be exported to `csv_export_path`"""
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.parquet as pq
+
+    # interpreter workers may have the previous version of the file memory-mapped:
+    # it's replaced with a new file instead of being truncated under their feet
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    preview = []
+    rows_fetched = 0
+    writers = []
+    csv_writer = None
     try:
-        logger.debug("tool: execute sql")
-        save_code(query, extension="sql", custom_name=meaningful_filename)
-        rows, schema = run_sql_query(query)
-        column_names = [col.name for col in schema]
-        if not meaningful_filename.endswith(".csv"):
-            meaningful_filename += ".csv"
-
-        with open(
-            f"{QUERY_RESULT_DIRECTORY}/{meaningful_filename}",
-            mode="w",
-            newline="",
-            encoding="utf-8",
-        ) as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(column_names)
-            writer.writerows(rows)  # type:ignore
-
-        header = "\t".join(column_names)
-        values = ""
-        for row in rows[:30]:  # TODO: this should be configurable from the config
-            values += "\t".join([str(cell) for cell in row])
-            values += "\n"
-        return f"(The full query result is available at the path {QUERY_RESULT_DIRECTORY}/{meaningful_filename})\n{header}\n{values}"
-    except Exception as e:
-        return f"{SQL_EXECUTION_ERROR_PREFIX} {str(e)}"
+        for batch in result.record_batches:
+            if not writers:
+                if result_format == "parquet":
+                    writers.append(pq.ParquetWriter(tmp_path, batch.schema))
+                else:
+                    writers.append(pa.ipc.new_file(tmp_path, batch.schema))
+                if csv_export_path is not None:
+                    csv_writer = pa.csv.CSVWriter(
+                        csv_export_path, _csv_compatible(batch).schema
+                    )
+                    writers.append(csv_writer)
+            if len(preview) < preview_rows:
+                preview += _batch_rows(batch.slice(0, preview_rows - len(preview)))
+            for writer in writers:
+                writer.write_batch(
+                    _csv_compatible(batch) if writer is csv_writer else batch
+                )
+            rows_fetched += batch.num_rows
+
+        if not writers:
+            # empty result, the file still needs a schema with the column types
+            empty = arrow_schema(result.schema).empty_table()
+            if result_format == "parquet":
+                pq.write_table(empty, tmp_path)
+            else:
+                with pa.ipc.new_file(tmp_path, empty.schema) as empty_writer:
+                    empty_writer.write_table(empty)
+            if csv_export_path is not None:
+                pa.csv.write_csv(_csv_compatible(empty), csv_export_path)
+    except BaseException:
+        for writer in writers:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    for writer in writers:
+        writer.close()
+    os.replace(tmp_path, path)
+    return preview, rows_fetched, os.path.getsize(path)
+
+
+def _csv_compatible(data):
+    """The record batch or table `data` with its ARRAY and STRUCT columns JSON-encoded,
+    the arrow csv writer doesn't support nested types"""
+    import pyarrow as pa
+
+    if not any(pa.types.is_nested(field.type) for field in data.schema):
+        return data
+    columns = [
+        (
+            pa.array(
+                [
+                    None if value is None else json.dumps(value, default=str)
+                    for value in column.to_pylist()
+                ],
+                type=pa.string(),
+            )
+            if pa.types.is_nested(column.type)
+            else column
+        )
+        for column in data.columns
+    ]
+    return type(data).from_arrays(columns, names=data.schema.names)
+
+
+def _batch_rows(batch) -> list[tuple]:
+    return list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+def _process_peak_rss_mb() -> float | None:
+    """Peak resident memory of the process since it started, `None` where it can't
+    be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
 
 
 @tool
 def fetch_metadata(user_question: str) -> str:
     """Fetch metadata about possibly relevant tables to the `user_question`"""
+    with span(TOOL, "fetch_metadata"):
+        return _fetch_metadata(user_question)
+
+
+def _fetch_metadata(user_question: str) -> str:
     logger.debug("tool: fetch metadata")
+    config = _get_config()
     metadata = get_table_metadata()
-    if len(metadata) > 5000:
-        logger.debug("raw metadata too long, calling LLM to parse it")
-        config = read_config("./config.yml")
-        llm = instantiate_llm(config)
-        response = llm.invoke(
-            [
-                SystemMessage(content=metadata_extraction),
-                HumanMessage(
-                    content=f"Original user question:\n{user_question}\n\nFull metadata fetched:\n{metadata}"
-                ),
-            ]
+    if len(metadata) > config.metadata_char_budget:
+        logger.debug("raw metadata too long, retrieving relevant tables")
+        catalog = get_catalog()
+        tables = search_tables(
+            catalog,
+            user_question,
+            top_k=config.metadata_top_k,
+            char_budget=config.metadata_char_budget,
         )
-        metadata = content_as_string(response)
+        if not tables:
+            return "No table matched the question. Available tables:\n" + "\n".join(
+                catalog.tables
+            )
+        metadata = catalog.render(tables)
+
+        if config.metadata_llm_rerank:
+            logger.debug("reranking retrieved metadata with the LLM")
+            llm = instantiate_llm(config)
+            response = llm.invoke(
+                [
+                    SystemMessage(content=metadata_extraction),
+                    HumanMessage(
+                        content=f"Original user question:\n{user_question}\n\nFull metadata fetched:\n{metadata}"
+                    ),
+                ]
+            )
+            metadata = content_as_string(response)
 
     return metadata
 
 
+def prefetch_metadata(user_question: str) -> str:
+    """Same output as the `fetch_metadata` tool, called by the graph without waiting
+    for the model to ask for it"""
+    with span(TOOL, "fetch_metadata"):
+        return _fetch_metadata(user_question)
+
+
+def metadata_is_complete(metadata: str) -> bool:
+    """Returns `True` if `metadata` is the whole schema, `fetch_metadata` can't
+    return anything it doesn't already describe"""
+    return metadata == get_table_metadata()
+
+
+def metadata_covers(metadata: str, user_question: str) -> bool:
+    """Returns `True` if `metadata` already describes every table retrieved for
+    `user_question`, e.g. when it was fetched for a previous question of the session"""
+    config = _get_config()
+    if len(get_table_metadata()) <= config.metadata_char_budget:
+        # the whole schema is returned whatever the question
+        return True
+    tables = search_tables(
+        get_catalog(),
+        user_question,
+        top_k=config.metadata_top_k,
+        char_budget=config.metadata_char_budget,
+    )
+    return all(f"Table: {table}\n" in metadata for table in tables)
+
+
+@tool
+def finish_data_fetching(reason: str) -> str:
+    """Call this tool, alone, when the data fetched so far is enough to answer the user question.
+    Provide a short `reason`. No more data will be fetched after this call"""
+    return f"Data fetching finished: {reason}"
+
+
 @tool
 def python_interpreter(code: str) -> str:
     """Execute arbitrary Python code in the current environment and return stdout + repr of last expression (if any).
     Use this to analyze data, create visualizations (e.g., matplotlib), or process files.
     The code runs in the same Python process as the agent — use with caution.
     """
+    with span(TOOL, "python_interpreter"):
+        output = _python_interpreter(code)
+        if output.startswith(PYTHON_EXECUTION_ERROR_PREFIX):
+            increment("failures")
+        return output
+
 
+def _python_interpreter(code: str) -> str:
     logger.debug("tool: python interpreter")
     code = code.replace("\\\\", "\\")
     script_path = save_code(code, extension="py")
 
     try:
-        result = subprocess.run(
-            [sys.executable, script_path],
-            capture_output=True,
-            text=True,
-            timeout=60,
-        )
-        output = result.stdout
-        errors = result.stderr
+        pool = _get_interpreter_pool()
+        if pool is not None:
+            returncode, output, errors = pool.run(
+                script_path, timeout=60, results_directory=QUERY_RESULT_DIRECTORY
+            )
+        else:
+            result = subprocess.run(
+                [sys.executable, script_path],
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+            returncode, output, errors = result.returncode, result.stdout, result.stderr
 
-        if result.returncode != 0:
+        if returncode != 0:
             return f"{PYTHON_EXECUTION_ERROR_PREFIX}: {errors}"
 
         if errors:
@@ -108,20 +428,53 @@ def python_interpreter(code: str) -> str:
 
         return output if output else "Code executed successfully (no output)"
 
-    except subprocess.TimeoutExpired:
+    except (subprocess.TimeoutExpired, TimeoutError):
         return f"{PYTHON_EXECUTION_ERROR_PREFIX}: Execution timed out"
     except Exception as e:
         return f"{PYTHON_EXECUTION_ERROR_PREFIX}: {e}"
 
 
+def uses_interpreter_pool(config: Config) -> bool:
+    """`False` if disabled in the config or in daemonic processes (e.g. batch workers),
+    that aren't allowed to start child processes: scripts then run in a new interpreter each
+    """
+    return config.python_pool_size > 0 and not multiprocessing.current_process().daemon
+
+
+def _get_interpreter_pool() -> InterpreterPool | None:
+    """Returns the process-wide warm interpreter pool, started on the first script.
+    `None` if it can't be used, see `uses_interpreter_pool`"""
+    global _interpreter_pool
+    config = _get_config()
+    if not uses_interpreter_pool(config):
+        return None
+
+    with _interpreter_pool_lock:
+        if _interpreter_pool is None:
+            _interpreter_pool = InterpreterPool(
+                config.python_pool_size, max_runs=config.python_pool_max_runs
+            )
+    return _interpreter_pool
+
+
 def save_code(code: str, extension: str, custom_name="generated") -> str:
-    directory = "generated_code"
+    directory = GENERATED_CODE_DIRECTORY
     os.makedirs(directory, exist_ok=True)
     file_path = os.path.join(directory, f"{custom_name}.{extension}")
 
-    if os.path.exists(file_path):
+    while True:
+        try:
+            # exclusive creation so that concurrent runs never overwrite each other
+            with open(file_path, "x") as f:
+                f.write(code)
+            return file_path
+        except FileExistsError:
+            pass
+
         # Find all existing generated-N.py files
-        pattern = re.compile(rf"^{custom_name}-(\d+)\.{re.escape(extension)}$")
+        pattern = re.compile(
+            rf"^{re.escape(custom_name)}-(\d+)\.{re.escape(extension)}$"
+        )
         max_num = 0
 
         for filename in os.listdir(directory):
@@ -132,7 +485,3 @@ def save_code(code: str, extension: str, custom_name="generated") -> str:
 
         new_filename = f"{custom_name}-{max_num + 1}.{extension}"
         file_path = os.path.join(directory, new_filename)
-
-    with open(file_path, "w") as f:
-        f.write(code)
-    return file_path
@@ -0,0 +1,114 @@
+import csv
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+import traceback
+from src.config import Config
+from src.logger import LLM_CALLS_LOG, configure_logger, logger
+
+
+_agent = None
+# traceback of the error raised building the agent
+_init_error: str | None = None
+
+
+def read_questions(filepath: str) -> list[dict]:
+    """Reads questions from a JSONL file (one object per line) or a CSV file, both
+    with a `question` field and an optional `id` (defaults to the record index)"""
+    if filepath.endswith(".csv"):
+        with open(filepath, newline="", encoding="utf-8") as f:
+            records = list(csv.DictReader(f))
+    else:
+        with open(filepath, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    questions = []
+    for i, record in enumerate(records):
+        if not record.get("question"):
+            raise ValueError(f"Missing question in record {i} of {filepath}")
+        questions.append(
+            {"id": record.get("id") or str(i), "question": record["question"]}
+        )
+    return questions
+
+
+def run_batch(
+    config: Config, questions: list[dict], output_path: str, workers: int
+) -> None:
+    """Answers `questions` on a pool of `workers` processes, each with its own agent.
+    Answers are appended to `output_path` (JSONL) as soon as they are ready"""
+    logger.info(f"Answering {len(questions)} questions with {workers} workers")
+    latencies = []
+    start = time.perf_counter()
+
+    # spawn so that workers don't inherit the parent's threads and open connections
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(config,)) as pool:
+        with open(output_path, "a", encoding="utf-8") as output:
+            for done, answer in enumerate(
+                pool.imap_unordered(_answer_question, questions), start=1
+            ):
+                output.write(json.dumps(answer, ensure_ascii=False) + "\n")
+                output.flush()
+                latencies.append(answer["latency"])
+                logger.info(
+                    f"[{done}/{len(questions)}] question {answer['id']} answered in {answer['latency']:.1f}s"
+                )
+        # lets the workers exit and flush their logs instead of being terminated
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Batch done in {elapsed:.1f}s: p50 {_percentile(latencies, 50):.1f}s, p95 {_percentile(latencies, 95):.1f}s, "
+        f"throughput {len(latencies) / max(elapsed, 1e-9) * 60:.1f} questions/min"
+    )
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest rank
+    rank = max(int(round(percentile / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _init_worker(config: Config) -> None:
+    global _agent, _init_error
+    # imported here to keep the parent process light
+    from src.agent.graph import Text2SqlAgent
+    from src.agent.tools import use_output_subdirectory
+
+    configure_logger(
+        config, llm_calls_log=LLM_CALLS_LOG.replace(".jsonl", f".{os.getpid()}.jsonl")
+    )
+    # pool workers exit without running atexit handlers, the LLM call records still
+    # queued for the background writer would be lost
+    multiprocessing.util.Finalize(None, logger.complete, exitpriority=10)
+    use_output_subdirectory(f"worker-{os.getpid()}")
+    try:
+        _agent = Text2SqlAgent(config)
+    except Exception as e:
+        # raising here would make the pool respawn the worker forever
+        logger.exception(f"Worker failed to build its agent: {e!r}")
+        _init_error = "".join(traceback.format_exception(e))
+
+
+def _answer_question(question: dict) -> dict:
+    start = time.perf_counter()
+    answer = {"id": question["id"], "question": question["question"]}
+    try:
+        if _agent is None:
+            raise RuntimeError(
+                f"Worker agent unavailable, init failed with:\n{_init_error}"
+            )
+        answer["answer"] = _agent.invoke(question["question"])  # type:ignore
+    except Exception as e:
+        logger.exception(f"Question {question['id']} failed")
+        answer["error"] = repr(e)
+    answer["latency"] = time.perf_counter() - start
+    answer["worker"] = os.getpid()
+    return answer
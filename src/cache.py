@@ -0,0 +1,135 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+from src.logger import logger
+
+
+CACHE_DIRECTORY = "./.cache"
+
+
+class SqliteCache:
+    """Persistent key-value cache stored in a SQLite file.
+    Entries expire after `ttl_seconds` and the least recently used ones are evicted
+    once the stored values exceed `max_bytes`. Values are pickled.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # one connection shared by all threads, serialized by `_lock`
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)"
+        )
+        self._conn.commit()
+
+    def get(
+        self, key: str, is_stale: Callable[[Any, float], bool] | None = None
+    ) -> Any | None:
+        """Returns the cached value for `key` or `None` on a miss.
+        `is_stale(value, created_at)` can invalidate an entry that didn't expire yet"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return self._miss()
+
+        blob, created_at = row
+        value = pickle.loads(blob)
+        if now - created_at > self.ttl_seconds or (
+            is_stale is not None and is_stale(value, created_at)
+        ):
+            self.delete(key)
+            return self._miss()
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            logger.debug(f"Not caching {key}, value is larger than the cache")
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def _miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _evict(self, now: float) -> None:
+        """Drops expired entries, then least recently used ones until under `max_bytes`.
+        Must be called holding `_lock`"""
+        self._conn.execute(
+            "DELETE FROM entries WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        (size,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if size <= self.max_bytes:
+            return
+
+        to_free = size - self.max_bytes
+        evicted = []
+        for key, entry_size in self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            if to_free <= 0:
+                break
+            evicted.append((key,))
+            to_free -= entry_size
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} entries from cache {self.path}")
@@ -0,0 +1,113 @@
+import os
+import pickle
+import threading
+import yaml
+from src.logger import logger
+
+
+SCHEMA_PATH = "schema.yaml"
+SNAPSHOT_SUFFIX = ".pkl"
+
+
+class SchemaCatalog:
+    """In memory index of the `schema.yaml` file produced by `gcp_pull_metadata`.
+    Tables are keyed by their full `dataset.table` name and columns by `(full_table_name, column)`
+    """
+
+    def __init__(self, datasets: list[dict], raw_yaml: str, mtime_ns: int = 0):
+        self.raw_yaml = raw_yaml
+        self.mtime_ns = mtime_ns
+        self.datasets: dict[str, dict] = {}
+        self.tables: dict[str, dict] = {}
+        self.columns: dict[tuple[str, str], dict] = {}
+        self.snippets: dict[str, str] = {}
+
+        for dataset in datasets or []:
+            self.datasets[dataset["name"]] = dataset
+            for table in dataset.get("tables", []):
+                full_table_name = f"{dataset['name']}.{table['name']}"
+                self.tables[full_table_name] = table
+                self.snippets[full_table_name] = _render_table(full_table_name, table)
+                for column in table.get("columns", []):
+                    self.columns[(full_table_name, column["name"])] = column
+
+    def get_dataset(self, dataset: str) -> dict | None:
+        return self.datasets.get(dataset)
+
+    def get_table(self, full_table_name: str) -> dict | None:
+        return self.tables.get(full_table_name)
+
+    def get_column(self, full_table_name: str, column: str) -> dict | None:
+        return self.columns.get((full_table_name, column))
+
+    def render(self, full_table_names: list[str] | None = None) -> str:
+        """Returns the precomputed description of the requested tables, or all of them"""
+        if full_table_names is None:
+            full_table_names = list(self.snippets)
+        return "".join(self.snippets[name] for name in full_table_names)
+
+
+def _render_table(full_table_name: str, table: dict) -> str:
+    table_desc = table.get("description") or "(Description not available)"
+    snippet = f"Table: {full_table_name}\n"
+    snippet += f"\tDescription: {table_desc}\n"
+    snippet += f"\tByte usage: {table.get('others', {}).get('num_bytes')}\n"
+    snippet += "\tColumns:\n"
+
+    for column in table.get("columns", []):
+        col_desc = column.get("description") or "(Description not available)"
+        snippet += f"\t\t{column['name']}:{column['type']} {col_desc}\n"
+
+    return snippet + "\n"
+
+
+_catalogs: dict[str, SchemaCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(path: str = SCHEMA_PATH) -> SchemaCatalog:
+    """Returns the catalog of the schema file at `path`, reloading it only when
+    the file modification time changed since the last load"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    catalog = _catalogs.get(path)
+    if catalog is not None and catalog.mtime_ns == mtime_ns:
+        return catalog
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(path)
+        if catalog is None or catalog.mtime_ns != mtime_ns:
+            catalog = _load_catalog(path, mtime_ns)
+            _catalogs[path] = catalog
+
+    return catalog
+
+
+def _load_catalog(path: str, mtime_ns: int) -> SchemaCatalog:
+    snapshot_path = path + SNAPSHOT_SUFFIX
+    try:
+        with open(snapshot_path, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot["mtime_ns"] == mtime_ns:
+            logger.debug(f"Loaded schema catalog from snapshot {snapshot_path}")
+            return SchemaCatalog(snapshot["datasets"], snapshot["raw_yaml"], mtime_ns)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable schema snapshot {snapshot_path}: {e}")
+
+    logger.debug(f"Parsing schema file {path}")
+    with open(path, "r") as f:
+        raw_yaml = f.read()
+    datasets = yaml.load(raw_yaml, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    try:
+        with open(snapshot_path, "wb") as f:
+            pickle.dump(
+                {"mtime_ns": mtime_ns, "datasets": datasets, "raw_yaml": raw_yaml},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except OSError as e:
+        logger.warning(f"Couldn't write schema snapshot {snapshot_path}: {e}")
+
+    return SchemaCatalog(datasets, raw_yaml, mtime_ns)
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 import yaml
 
@@ -18,7 +18,82 @@ class Config:
     provider: str
     model_settings: ModelSettings
     max_retries: int = 5
+    # keep the state of a session (metadata, query results, python output) between its
+    # questions: "memory", "sqlite" (needs langgraph-checkpoint-sqlite, `invoke` only) or "off"
+    session_checkpointer: str = "memory"
+    # query results carried to the next question of a session, the oldest are dropped
+    session_max_results: int = 10
+    # sessions idle for longer than this (seconds) start over
+    session_ttl: int = 3600
+    # messages kept in the graph state, older ones are dropped once their outputs were
+    # copied in the state slots (0 keeps all of them)
+    message_window: int = 30
     log_level: str = "INFO"
+    # size of logs/llm_calls.jsonl (logs/llm_calls.<pid>.jsonl for batch workers) before
+    # it's rotated and rotated files kept
+    llm_log_max_mb: int = 50
+    llm_log_retention: int = 5
+    # cumulative node/tool/LLM metrics are written here after every question,
+    # as JSON if the path ends with .json otherwise in the Prometheus text format
+    metrics_path: Optional[str] = None
+    # rows fetched per page when streaming query results
+    query_page_size: int = 10000
+    # rows of each query result shown to the model
+    query_preview_rows: int = 30
+    # file format of the full query results: csv, parquet or arrow (IPC, memory mappable)
+    query_result_format: str = "arrow"
+    # also export parquet/arrow results as csv
+    query_result_csv_export: bool = False
+    # BigQuery jobs run at the same time when the model asks for several queries at once
+    max_concurrent_queries: int = 4
+    # dry run queries before submitting them: off, flag (log a warning) or reject
+    # queries estimated to process more than dry_run_max_mb
+    dry_run: str = "off"
+    dry_run_max_mb: int = 100
+    # parse queries and check tables/columns against schema.yaml before running them
+    static_sql_validation: bool = True
+    # warm python processes running the generated scripts, 0 starts a new interpreter per script
+    python_pool_size: int = 2
+    # scripts run by a pooled process before it's replaced with a fresh one
+    python_pool_max_runs: int = 20
+    # open the BigQuery connection when the agent is built instead of on first query
+    warm_up_db: bool = True
+    # concurrent requests used when pulling the schema metadata from BigQuery
+    metadata_concurrency: int = 16
+    # worker processes, each with its own agent, used to answer a questions file
+    batch_workers: int = 4
+    # metadata longer than this is narrowed down to the tables retrieved for the question
+    metadata_char_budget: int = 5000
+    metadata_top_k: int = 10
+    # let the LLM further prune the retrieved tables
+    metadata_llm_rerank: bool = False
+    # retrieve the metadata for the question before the first generation, saving the
+    # LLM round trip asking for it
+    metadata_prefetch: bool = True
+    # how the agent decides if the fetched data is enough: "llm" asks the model in a
+    # separate call, "inline" lets the generation node call a finish tool instead
+    sufficiency_evaluation: str = "llm"
+    # skip the decision when a simple lookup question ("how many...") got its query result
+    skip_lookup_evaluation: bool = True
+    # ceiling on the estimated tokens (4 characters each) of the system prompt of every
+    # LLM node: metadata, data previews and python outputs are cut down to fit
+    prompt_token_budget: int = 8000
+    # per node overrides of prompt_token_budget, e.g. {"answer": 4000}
+    prompt_token_budgets: dict[str, int] = field(default_factory=dict)
+    # on disk cache of query results keyed by project and normalized SQL. Cached results
+    # are served for up to query_cache_ttl seconds even if the tables changed meanwhile
+    query_cache_enabled: bool = False
+    query_cache_ttl: int = 3600
+    query_cache_max_mb: int = 512
+    # results with more rows are streamed without being cached
+    query_cache_max_rows: int = 50000
+    # check the last modification time of the queried tables before serving a cached result
+    query_cache_check_modified: bool = False
+    # on disk cache of LLM responses keyed by model, settings, messages and bound tools.
+    # Responses are reused verbatim so it only makes sense with a temperature close to 0
+    llm_cache_enabled: bool = False
+    llm_cache_ttl: int = 86400
+    llm_cache_max_mb: int = 256
 
 
 def read_config(filepath: str = "config.yml") -> Config:
@@ -41,4 +116,19 @@ def read_config(filepath: str = "config.yml") -> Config:
     model_settings_dict = config.pop("model_settings")
     model_settings = ModelSettings(**model_settings_dict)
 
+    result_format = config.get("query_result_format", "arrow")
+    if result_format not in ["csv", "parquet", "arrow"]:
+        raise ValueError(f"Unsupported query_result_format: {result_format}")
+    sufficiency_evaluation = config.get("sufficiency_evaluation", "llm")
+    if sufficiency_evaluation not in ["llm", "inline"]:
+        raise ValueError(
+            f"Unsupported sufficiency_evaluation mode: {sufficiency_evaluation}"
+        )
+    session_checkpointer = config.get("session_checkpointer", "memory")
+    if session_checkpointer not in ["memory", "sqlite", "off"]:
+        raise ValueError(f"Unsupported session_checkpointer: {session_checkpointer}")
+    dry_run = config.get("dry_run", "off")
+    if dry_run not in ["off", "flag", "reject"]:
+        raise ValueError(f"Unsupported dry_run mode: {dry_run}")
+
     return Config(**config, model_settings=model_settings)
@@ -1,87 +1,568 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from google.api_core.exceptions import (
+    Forbidden,
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests,
+)
 from google.cloud import bigquery
 from google.cloud.bigquery.table import Row
+import os
+from requests.adapters import HTTPAdapter
+import random
 import re
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
 import yaml
+from src.cache import CACHE_DIRECTORY, SqliteCache
+from src.catalog import SCHEMA_PATH, get_catalog
+from src.config import Config
+from src.logger import logger
+from src.sql_analysis import analyze_query
 
 
-def _validate_query(query: str) -> str:
-    for forbidden_keyword in ["INSERT", "ALTER", "UPDATE", "DROP", "DELETE"]:
-        if forbidden_keyword in query:
-            raise ValueError(
-                f"Keyword {forbidden_keyword} is forbidden in this environment. DB altering statements have been disabled"
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+HTTP_POOL_SIZE = 32
+
+_clients: dict[str, bigquery.Client] = {}
+_clients_lock = threading.Lock()
+_default_project: str | None = None
+_config: Config | None = None
+_query_cache: SqliteCache | None = None
+# estimated bytes processed by dry runs, keyed by `query_cache_key`
+_dry_run_cache: OrderedDict[str, int] = OrderedDict()
+_dry_run_cache_lock = threading.Lock()
+DRY_RUN_CACHE_SIZE = 1024
+
+
+def configure_db(config: Config) -> None:
+    """Sets the default GCP project used by every DB call, opens the query result cache
+    and optionally warms up the client in the background so that the first query doesn't
+    pay auth and TLS handshake costs"""
+    global _default_project, _config, _query_cache
+    _default_project = config.gcp_project
+    _config = config
+
+    if config.query_cache_enabled:
+        _query_cache = SqliteCache(
+            os.path.join(CACHE_DIRECTORY, "query_results.sqlite"),
+            ttl_seconds=config.query_cache_ttl,
+            max_bytes=config.query_cache_max_mb * 1024 * 1024,
+        )
+
+    if config.warm_up_db:
+        # in the background, overlapping with the first LLM call
+        threading.Thread(target=_warm_up_client, daemon=True).start()
+
+
+def _warm_up_client() -> None:
+    try:
+        client = get_client()
+        # cheap authenticated round trip that opens a pooled connection
+        list(client.list_datasets(max_results=1))
+    except Exception as e:
+        logger.warning(f"BigQuery client warm up failed: {e}")
+
+
+def use_client(client, project: str | None = None) -> None:
+    """Makes every DB call for `project` (defaults to the configured one) go through
+    `client`, any object exposing the subset of the `bigquery.Client` API used here"""
+    project = project or _default_project
+    if project is None:
+        raise ValueError("No GCP project configured, call `configure_db` first")
+    with _clients_lock:
+        _clients[project] = client
+
+
+def get_client(project: str | None = None) -> bigquery.Client:
+    """Returns the process-wide BigQuery client for `project` (defaults to the configured one),
+    creating it on first use. Clients are thread safe and share a pooled HTTP session"""
+    project = project or _default_project
+    if project is None:
+        raise ValueError("No GCP project configured, call `configure_db` first")
+
+    client = _clients.get(project)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        # another thread might have created it while we were waiting
+        client = _clients.get(project)
+        if client is None:
+            logger.debug(f"Creating BigQuery client for project {project}")
+            client = bigquery.Client(project=project)
+            # requests default pool keeps only 10 connections per host
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
             )
+            client._http.mount("https://", adapter)
+            _clients[project] = client
+
+    return client
 
+
+def _validate_query(query: str) -> str:
     cleaned_query = query.removeprefix("```sql")
     cleaned_query = cleaned_query.removeprefix("```")
     cleaned_query = cleaned_query.removesuffix("```")
     cleaned_query = cleaned_query.strip().rstrip(";")
+
+    if _config is not None and _config.static_sql_validation:
+        # parser based check of statement kind, tables and columns
+        catalog = get_catalog() if os.path.exists(SCHEMA_PATH) else None
+        analyze_query(cleaned_query, catalog, project=_config.gcp_project)
+    else:
+        for forbidden_keyword in ["INSERT", "ALTER", "UPDATE", "DROP", "DELETE"]:
+            if forbidden_keyword in query:
+                raise ValueError(
+                    f"Keyword {forbidden_keyword} is forbidden in this environment. DB altering statements have been disabled"
+                )
+
     return cleaned_query
 
 
-def run_sql_query(query: str) -> list[Row]:
+_QUOTED = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+
+
+def normalize_query(query: str) -> str:
+    """Returns a canonical form of an already validated `query` to be used as cache key.
+    Only whitespace outside of quoted strings and identifiers is collapsed: casing is
+    kept, aliases name the result columns and BigQuery table names are case sensitive
+    """
+    normalized = []
+    for part in _QUOTED.split(query):
+        if _QUOTED.fullmatch(part):
+            normalized.append(part)
+        else:
+            normalized.append(re.sub(r"\s+", " ", part))
+    return "".join(normalized).strip()
+
+
+def query_cache_key(query: str, project: str | None = None) -> str:
+    """Cache key of an already validated `query` run in `project` (defaults to the
+    configured one), where unqualified `dataset.table` names are resolved. The settings
+    of `_job_config` only cap the cost of a query, they don't change its rows"""
+    return f"{project or _default_project}:{normalize_query(query)}"
+
+
+@dataclass
+class QueryResult:
+    """Result of a query whose rows are fetched lazily one page at a time"""
+
+    schema: list[bigquery.SchemaField]
+    pages: Iterator[list]
+    # same rows as `pages` as pyarrow record batches, only one of the two can be consumed
+    record_batches: Iterator["pa.RecordBatch"]
+    total_rows: int | None = None
+    bytes_processed: int | None = None
+    from_cache: bool = False
+
+
+def run_sql_query(query: str, page_size: int | None = None) -> QueryResult:
+    """Runs `query` and returns its result, rows are streamed page by page
+    as the caller iterates over `QueryResult.pages`"""
+    query, cache_key, cached = _prepare_query(query, page_size)
+    if cached is not None:
+        return cached
+
+    query_job = get_client().query(query, job_config=_job_config(), timeout=30.0)
+    return _query_result(query_job, cache_key, page_size)
+
+
+async def arun_sql_query(query: str, page_size: int | None = None) -> QueryResult:
+    """Async version of `run_sql_query`: the job is polled without blocking the event loop,
+    blocking client calls run in worker threads"""
+    query, cache_key, cached = await asyncio.to_thread(_prepare_query, query, page_size)
+    if cached is not None:
+        return cached
+
+    query_job = await asyncio.to_thread(
+        get_client().query, query, job_config=_job_config(), timeout=30.0
+    )
+    delay = 0.1
+    # `done` reloads the job state with a single request, unlike `result` that blocks
+    while not await asyncio.to_thread(query_job.done):
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+
+    return await asyncio.to_thread(_query_result, query_job, cache_key, page_size)
+
+
+def _prepare_query(
+    query: str, page_size: int | None
+) -> tuple[str, str, QueryResult | None]:
+    """Validates `query` and checks its cost. Returns the cleaned query, its cache key and
+    the cached result if available"""
     query = _validate_query(query)
-    job_config = bigquery.QueryJobConfig(
+    cache_key = query_cache_key(query)
+    if _query_cache is not None:
+        check_modified = _config.query_cache_check_modified  # type:ignore
+        cached = _query_cache.get(
+            cache_key, is_stale=_tables_modified_since if check_modified else None
+        )
+        if cached is not None:
+            logger.debug(f"Query result cache hit ({_query_cache.stats()})")
+            return query, cache_key, _result_from_cache(cached, page_size)
+
+    if _config is not None and _config.dry_run != "off":
+        _check_query_cost(query, cache_key, _config)
+
+    return query, cache_key, None
+
+
+def _job_config() -> bigquery.QueryJobConfig:
+    return bigquery.QueryJobConfig(
         use_query_cache=True,
         maximum_bytes_billed=100 * 1024 * 1024,  # 100 MB cap
     )
-    client = bigquery.Client(project="soges-group-data-platform")
-    # client = bigquery.Client(project="formazione-danieletarek-iaisy")
+
+
+def _query_result(query_job, cache_key: str, page_size: int | None) -> QueryResult:
+    result = query_job.result(page_size=page_size)
+    pages = (list(page) for page in result.pages)
+    record_batches = _lazy(result.to_arrow_iterable)
+    if _query_cache is not None:
+        pages = _caching_pages(pages, cache_key, result.schema, query_job)
+        record_batches = _caching_pages(
+            record_batches, cache_key, result.schema, query_job
+        )
+
+    return QueryResult(
+        schema=result.schema,
+        pages=pages,
+        record_batches=record_batches,
+        total_rows=result.total_rows,
+        bytes_processed=query_job.total_bytes_processed,
+    )
+
+
+def dry_run_query(
+    query: str, cache_key: str | None = None, client: bigquery.Client | None = None
+) -> int:
+    """Returns the bytes BigQuery estimates `query` would process, without running it.
+    Estimates are cached per normalized query and project"""
+    cache_key = cache_key or query_cache_key(query, client.project if client else None)
+    with _dry_run_cache_lock:
+        if cache_key in _dry_run_cache:
+            _dry_run_cache.move_to_end(cache_key)
+            return _dry_run_cache[cache_key]
+
+    client = client or get_client()
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
     query_job = client.query(query, job_config=job_config, timeout=30.0)
-    result = query_job.result()
+    estimated_bytes = query_job.total_bytes_processed or 0
+
+    with _dry_run_cache_lock:
+        _dry_run_cache[cache_key] = estimated_bytes
+        if len(_dry_run_cache) > DRY_RUN_CACHE_SIZE:
+            _dry_run_cache.popitem(last=False)
+    return estimated_bytes
+
 
-    return list(result), result.schema  # type:ignore
+def _check_query_cost(query: str, cache_key: str, config: Config) -> None:
+    """Dry runs `query` and rejects it (raising `ValueError`) or logs a warning
+    if it would process more than the configured budget"""
+    estimated_mb = dry_run_query(query, cache_key) / 1024**2
+    logger.debug(f"Dry run estimate: {estimated_mb:.1f} MB processed")
+    if estimated_mb <= config.dry_run_max_mb:
+        return
 
+    message = f"The query would process {estimated_mb:.1f} MB, over the budget of {config.dry_run_max_mb} MB."
+    if config.dry_run == "reject":
+        raise ValueError(
+            f"{message} Write a cheaper query: select only the needed columns, filter on partitioning columns or aggregate in the query"
+        )
+    logger.warning(message)
 
-def gcp_pull_metadata(project_id: str, datasets: list[str] | None = None) -> None:
+
+def _lazy(make_iterator: Callable[[], Iterator]) -> Iterator:
+    """Defers the creation of an iterator until it's first consumed"""
+    yield from make_iterator()
+
+
+def _caching_pages(pages: Iterator, cache_key: str, schema, query_job) -> Iterator:
+    """Yields `pages` (lists of rows or record batches) unchanged and stores them in the
+    query cache once exhausted, unless the result has more rows than are worth caching
+    """
+    rows = []
+    for page in pages:
+        if rows is not None:
+            if isinstance(page, list):
+                rows.extend(row.values() for row in page)
+            else:
+                rows.extend(zip(*(column.to_pylist() for column in page.columns)))
+            if len(rows) > _config.query_cache_max_rows:  # type:ignore
+                rows = None
+        yield page
+
+    if rows is not None:
+        _query_cache.set(  # type:ignore
+            cache_key,
+            {
+                "rows": rows,
+                "schema": [field.to_api_repr() for field in schema],
+                "tables": [
+                    table.to_api_repr() for table in query_job.referenced_tables
+                ],
+            },
+        )
+
+
+def query_cache_stats() -> dict | None:
+    """Hit/miss statistics of the query result cache, `None` if it's disabled"""
+    return _query_cache.stats() if _query_cache is not None else None
+
+
+def _result_from_cache(cached: dict, page_size: int | None) -> QueryResult:
+    schema = [bigquery.SchemaField.from_api_repr(field) for field in cached["schema"]]
+    field_to_index = {field.name: i for i, field in enumerate(schema)}
+    rows = [Row(values, field_to_index) for values in cached["rows"]]
+    page_size = page_size or max(len(rows), 1)
+    pages = (rows[i : i + page_size] for i in range(0, len(rows), page_size))
+    return QueryResult(
+        schema=schema,
+        pages=pages,
+        record_batches=_record_batches(rows, schema, page_size),
+        total_rows=len(rows),
+        bytes_processed=0,
+        from_cache=True,
+    )
+
+
+def _record_batches(
+    rows: list[Row], schema: list[bigquery.SchemaField], page_size: int
+) -> Iterator:
+    """Cached `rows` as record batches of `page_size` rows, all with the arrow types of
+    the BigQuery `schema`: types inferred page by page wouldn't match when a column
+    is all NULL in some pages"""
+    import pyarrow as pa
+
+    batch_schema = arrow_schema(schema, rows)
+    for start in range(0, len(rows), page_size):
+        page = rows[start : start + page_size]
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column) for column in zip(*page)], schema=batch_schema
+        )
+
+
+def arrow_schema(
+    schema: list[bigquery.SchemaField], rows: list | tuple = ()
+) -> "pa.Schema":
+    """Arrow schema of a result with the BigQuery `schema`, the types without a known
+    mapping are inferred from the `rows` of the result"""
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            pa.field(field.name, _arrow_type(field, [row[i] for row in rows]))
+            for i, field in enumerate(schema)
+        ]
+    )
+
+
+def _arrow_type(field: bigquery.SchemaField, values: list) -> "pa.DataType":
+    """Arrow type of the BigQuery `field`, the same `to_arrow_iterable` gives live
+    results. Types without a known mapping are inferred from all the `values`"""
+    import pyarrow as pa
+
+    scalar_types = {
+        "BOOL": pa.bool_(),
+        "BOOLEAN": pa.bool_(),
+        "BYTES": pa.binary(),
+        "DATE": pa.date32(),
+        "DATETIME": pa.timestamp("us"),
+        "FLOAT": pa.float64(),
+        "FLOAT64": pa.float64(),
+        "GEOGRAPHY": pa.string(),
+        "INT64": pa.int64(),
+        "INTEGER": pa.int64(),
+        "NUMERIC": pa.decimal128(38, 9),
+        "BIGNUMERIC": pa.decimal256(76, 38),
+        "STRING": pa.string(),
+        "TIME": pa.time64("us"),
+        "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    }
+    if field.field_type in ("RECORD", "STRUCT"):
+        arrow_type = pa.struct(
+            [
+                pa.field(
+                    subfield.name,
+                    _arrow_type(subfield, _subfield_values(subfield.name, values)),
+                )
+                for subfield in field.fields
+            ]
+        )
+    elif field.field_type in scalar_types:
+        arrow_type = scalar_types[field.field_type]
+    else:
+        return pa.array(values).type
+
+    if field.mode == "REPEATED":
+        return pa.list_(arrow_type)
+    return arrow_type
+
+
+def _subfield_values(name: str, values: list) -> list:
+    """Values of the `name` field of the struct `values`, flattening repeated ones"""
+    subfield_values = []
+    for value in values:
+        for struct in value if isinstance(value, list) else [value]:
+            if struct is not None:
+                subfield_values.append(struct.get(name))
+    return subfield_values
+
+
+def _tables_modified_since(cached: dict, created_at: float) -> bool:
+    """Invalidation hook of the query cache: `True` if any table read by the
+    cached query was modified after the result was stored"""
+    client = get_client()
+    for table in cached["tables"]:
+        ref = bigquery.TableReference.from_api_repr(table)
+        modified = client.get_table(ref).modified
+        if modified is not None and modified.timestamp() > created_at:
+            logger.debug(f"Cached result is stale, {ref} was modified at {modified}")
+            return True
+    return False
+
+
+def gcp_pull_metadata(
+    project_id: str,
+    datasets: list[str] | None = None,
+    max_workers: int = 16,
+    max_retries: int = 5,
+) -> None:
     """
     Fetches BigQuery metadata from GCP project and saves it to a YAML file.
+    Datasets and tables are fetched concurrently but the output keeps the listing order.
 
     Args:
         project_id: GCP project ID
         datasets: list of dataset names to pull, if unspecified all datasets will be pulled
+        max_workers: maximum number of concurrent metadata requests
+        max_retries: how many times a request is retried when hitting quota/rate limits
     """
-    client = bigquery.Client(project=project_id)
-    metadata = []
-
-    # dataset iteration to find available metadata
-    for dataset_ref in client.list_datasets():
-        dataset = client.get_dataset(dataset_ref.reference)
-        if datasets is not None and dataset.dataset_id not in datasets:
-            continue
-
-        dataset_info = {
-            "name": dataset.dataset_id,
-            "kind": "dataset",
-            "description": dataset.description or "",
-            "tables": [],
-            "others": _extract_other_metadata(dataset),
-        }
+    client = get_client(project_id)
+    dataset_refs = [
+        dataset_ref
+        for dataset_ref in client.list_datasets()
+        if datasets is None or dataset_ref.dataset_id in datasets
+    ]
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # dataset iteration to find available metadata
+        dataset_futures = [
+            pool.submit(
+                _with_backoff, client.get_dataset, dataset_ref.reference, max_retries
+            )
+            for dataset_ref in dataset_refs
+        ]
+        table_list_futures = [
+            pool.submit(
+                _with_backoff,
+                lambda ref: list(client.list_tables(ref)),
+                dataset_ref.reference,
+                max_retries,
+            )
+            for dataset_ref in dataset_refs
+        ]
         # getting tables metadata
-        for table_ref in client.list_tables(dataset):
-            table = client.get_table(table_ref.reference)
-            table_info = {
-                "name": table.table_id,
-                "kind": "table",
-                "description": table.description or "",
-                "columns": [],
-                "others": _extract_other_metadata(table),
+        table_futures = [
+            [
+                pool.submit(
+                    _with_backoff, client.get_table, table_ref.reference, max_retries
+                )
+                for table_ref in future.result()
+            ]
+            for future in table_list_futures
+        ]
+        total_tables = sum(len(futures) for futures in table_futures)
+        logger.info(
+            f"Pulling metadata of {total_tables} tables from {len(dataset_refs)} datasets"
+        )
+        _report_progress(
+            [future for futures in table_futures for future in futures], start
+        )
+
+        metadata = []
+        for dataset_future, futures in zip(dataset_futures, table_futures):
+            dataset = dataset_future.result()
+            dataset_info = {
+                "name": dataset.dataset_id,
+                "kind": "dataset",
+                "description": dataset.description or "",
+                "tables": [_table_info(future.result()) for future in futures],
+                "others": _extract_other_metadata(dataset),
             }
+            metadata.append(dataset_info)
 
-            # getting column metadata
-            for field in table.schema:
-                column_info = {
-                    "name": field.name,
-                    "type": field.field_type,
-                    "description": field.description or "",
-                }
-                table_info["columns"].append(column_info)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Pulled {total_tables} tables in {elapsed:.1f}s ({total_tables / max(elapsed, 1e-9):.1f} tables/sec)"
+    )
+    with open("schema.yaml", "w") as f:
+        yaml.dump(metadata, f, default_flow_style=False, sort_keys=False)
 
-            dataset_info["tables"].append(table_info)
 
-        metadata.append(dataset_info)
+def _table_info(table) -> dict:
+    table_info = {
+        "name": table.table_id,
+        "kind": "table",
+        "description": table.description or "",
+        "columns": [],
+        "others": _extract_other_metadata(table),
+    }
 
-    with open("schema.yaml", "w") as f:
-        yaml.dump(metadata, f, default_flow_style=False, sort_keys=False)
+    # getting column metadata
+    for field in table.schema:
+        column_info = {
+            "name": field.name,
+            "type": field.field_type,
+            "description": field.description or "",
+        }
+        table_info["columns"].append(column_info)
+
+    return table_info
+
+
+def _report_progress(futures: list[Future], start: float, every: int = 100) -> None:
+    """Blocks until all `futures` are done, logging progress and throughput"""
+    for done, _ in enumerate(as_completed(futures), start=1):
+        if done % every == 0 or done == len(futures):
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Pulled {done}/{len(futures)} tables ({done / max(elapsed, 1e-9):.1f} tables/sec)"
+            )
+
+
+def _is_quota_error(error: Exception) -> bool:
+    if isinstance(error, (TooManyRequests, ServiceUnavailable, InternalServerError)):
+        return True
+    if isinstance(error, Forbidden):
+        reasons = {err.get("reason") for err in error.errors or []}
+        return bool(reasons & {"rateLimitExceeded", "quotaExceeded"})
+    return False
+
+
+def _with_backoff(fn: Callable, arg, max_retries: int, base_delay: float = 1.0):
+    """Calls `fn(arg)` retrying with exponential backoff and jitter on quota errors"""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(arg)
+        except Exception as e:
+            if not _is_quota_error(e) or attempt == max_retries:
+                raise
+            delay = min(base_delay * 2**attempt, 32.0) + random.uniform(0, base_delay)
+            logger.warning(f"Quota error on {arg}, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
 
 
 def _extract_other_metadata(resource) -> dict:
@@ -109,33 +590,9 @@ def _extract_other_metadata(resource) -> dict:
     return others
 
 
-def get_table_metadata():
-    with open("schema.yaml", "r") as f:
-        yaml_str = f.read()
-        datasets = yaml.safe_load(yaml_str)
-
-    if not datasets:
+def get_table_metadata() -> str:
+    catalog = get_catalog()
+    if not catalog.datasets:
         return "No datasets found in schema file."
 
-    schema_str = ""
-    for dataset in datasets:
-        dataset_name = dataset["name"]
-
-        for table in dataset.get("tables", []):
-            full_table_name = f"{dataset_name}.{table['name']}"
-            table_desc = table.get("description", "(Description not available)")
-            schema_str += f"Table: {full_table_name}\n"
-            schema_str += f"\tDescription: {table_desc}\n"
-            schema_str += f"\tByte usage: {table['others']['num_bytes']}\n"
-            schema_str += "\tColumns:\n"
-
-            for column in table.get("columns", []):
-                col_name = column["name"]
-                col_type = column["type"]
-                col_desc = column.get("description", "(Description not available)")
-                schema_str += f"\t\t{col_name}:{col_type} {col_desc}\n"
-
-            schema_str += "\n"
-
-    # return schema_str
-    return yaml_str
+    return catalog.raw_yaml
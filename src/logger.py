@@ -4,9 +4,28 @@ from src.config import Config
 
 
 _initialized = False
+# JSONL trail of every LLM call, records are tagged with LLM_CALL_KEY
+LLM_CALLS_LOG = "logs/llm_calls.jsonl"
+LLM_CALL_KEY = "llm_call"
 
 
-def configure_logger(config: Config):
+def _is_llm_call(record) -> bool:
+    return LLM_CALL_KEY in record["extra"]
+
+
+def _is_not_llm_call(record) -> bool:
+    return LLM_CALL_KEY not in record["extra"]
+
+
+# until configure_logger is called records go to loguru's default sink, but the
+# LLM call records (full prompts) are only meant for their own file
+logger.remove()
+logger.add(sys.stderr, filter=_is_not_llm_call)
+
+
+def configure_logger(config: Config, llm_calls_log: str = LLM_CALLS_LOG):
+    """`llm_calls_log` must be different for every process, rotations of a file shared
+    by several processes would interfere with each other"""
     global _initialized
 
     if not _initialized:
@@ -18,6 +37,7 @@ def configure_logger(config: Config):
             sys.stderr,
             level=config.log_level,
             # format=log_format,
+            filter=_is_not_llm_call,
             colorize=True,  # Enable colors in terminal
             diagnose=True,
         )
@@ -27,11 +47,23 @@ def configure_logger(config: Config):
             # retention="10 days",
             level=config.log_level,
             # format=log_format,
+            filter=_is_not_llm_call,
             # compression="zip",  # Compress rotated files
             # enqueue=True,  # Async-safe (for multi-threading)
             # backtrace=True,  # Include error traces
             diagnose=True,  # Include variable values in errors
         )
+        logger.add(
+            llm_calls_log,
+            format="{message}",
+            filter=_is_llm_call,
+            level="INFO",
+            rotation=f"{config.llm_log_max_mb} MB",
+            retention=config.llm_log_retention,
+            # records are written in the background, callers never wait for the file.
+            # Pending records are flushed when the handler is removed at exit
+            enqueue=True,
+        )
 
         _initialized = True
     else:
@@ -0,0 +1,175 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import threading
+import time
+from src.logger import logger
+
+
+# kinds of spans: whole graph runs, graph nodes, tools and LLM calls
+GRAPH = "graph"
+NODE = "node"
+TOOL = "tool"
+LLM = "llm"
+
+_lock = threading.Lock()
+# cumulative metrics of the process by (kind, name)
+_totals: dict[tuple[str, str], dict] = {}
+_current_trace: ContextVar["Trace | None"] = ContextVar("trace", default=None)
+_current_counters: ContextVar[dict | None] = ContextVar("span_counters", default=None)
+
+
+class Trace:
+    """Spans recorded while answering a single question"""
+
+    def __init__(self, question: str):
+        self.question = question
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: dict) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def visits(self, name: str, kind: str = NODE) -> int:
+        """Times the span `name` was recorded, for nodes how many times the graph went through them"""
+        return sum(1 for s in self.spans if s["kind"] == kind and s["name"] == name)
+
+    def summary(self) -> str:
+        by_span: dict[tuple[str, str], dict] = defaultdict(lambda: defaultdict(float))
+        for s in self.spans:
+            aggregate = by_span[(s["kind"], s["name"])]
+            aggregate["count"] += 1
+            aggregate["seconds"] += s["seconds"]
+            for key, value in s["counters"].items():
+                aggregate[key] += value
+
+        lines = [f"Answered in {self.elapsed:.2f}s: {self.question[:80]!r}"]
+        for (kind, name), aggregate in sorted(
+            by_span.items(), key=lambda item: -item[1]["seconds"]
+        ):
+            counters = " ".join(
+                f"{key}={value:g}"
+                for key, value in aggregate.items()
+                if key not in ("count", "seconds")
+            )
+            lines.append(
+                f"\t{kind:<5} {name:<24} x{aggregate['count']:<3g} {aggregate['seconds']:8.2f}s {counters}"
+            )
+        return "\n".join(lines)
+
+
+@contextmanager
+def trace(question: str):
+    """Collects every span recorded while answering `question`, including the ones
+    of nodes and tools running on other threads or tasks, then logs a summary"""
+    current = Trace(question)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current.elapsed = time.perf_counter() - current.start
+        logger.info(current.summary())
+
+
+@contextmanager
+def span(kind: str, name: str):
+    """Times the enclosed block. Yields a dictionary of counters (tokens, bytes, ...)
+    that is summed to the cumulative metrics, `increment` adds to the innermost span"""
+    counters: dict[str, float] = {}
+    token = _current_counters.set(counters)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield counters
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _current_counters.reset(token)
+        record(kind, name, time.perf_counter() - start, counters, failed)
+
+
+def increment(key: str, value: float = 1) -> None:
+    """Adds `value` to the `key` counter of the innermost span, if any"""
+    counters = _current_counters.get()
+    if counters is not None:
+        counters[key] = counters.get(key, 0) + value
+
+
+def record(
+    kind: str, name: str, seconds: float, counters: dict, failed: bool = False
+) -> None:
+    """Records an already measured span"""
+    counters = {k: v for k, v in counters.items() if v is not None}
+    current = _current_trace.get()
+    if current is not None:
+        current.add(
+            {"kind": kind, "name": name, "seconds": seconds, "counters": counters}
+        )
+
+    with _lock:
+        totals = _totals.setdefault(
+            (kind, name), {"count": 0, "errors": 0, "seconds": 0.0, "counters": {}}
+        )
+        totals["count"] += 1
+        totals["errors"] += int(failed)
+        totals["seconds"] += seconds
+        for key, value in counters.items():
+            totals["counters"][key] = totals["counters"].get(key, 0) + value
+
+
+def snapshot() -> list[dict]:
+    """Cumulative metrics of the process, one entry per span kind and name"""
+    with _lock:
+        return [
+            {"kind": kind, "name": name, **totals, "counters": dict(totals["counters"])}
+            for (kind, name), totals in sorted(_totals.items())
+        ]
+
+
+def export_metrics(path: str) -> None:
+    """Writes the cumulative metrics to `path` as JSON if it ends with `.json`,
+    otherwise in the Prometheus text format (e.g. for node_exporter textfile collector)
+    """
+    metrics = snapshot()
+    if path.endswith(".json"):
+        content = json.dumps(metrics, indent=2)
+    else:
+        content = _prometheus_text(metrics)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # scrapers must never read a partially written file
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _prometheus_text(metrics: list[dict]) -> str:
+    # samples of the same metric must be grouped under its TYPE line
+    families = defaultdict(list)
+    for metric in metrics:
+        labels = f'kind="{metric["kind"]}",name="{metric["name"]}"'
+        families["span_seconds summary"] += [
+            f"text2sql_span_seconds_sum{{{labels}}} {metric['seconds']}",
+            f"text2sql_span_seconds_count{{{labels}}} {metric['count']}",
+        ]
+        families["span_errors_total counter"].append(
+            f"text2sql_span_errors_total{{{labels}}} {metric['errors']}"
+        )
+        for key, value in metric["counters"].items():
+            families[f"{key}_total counter"].append(
+                f"text2sql_{key}_total{{{labels}}} {value}"
+            )
+
+    lines = []
+    for family, samples in families.items():
+        lines.append(f"# TYPE text2sql_{family}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
@@ -6,6 +6,7 @@ To answer the user question you have available different tools:
 - to fetch metadata about the underlying db you can use the fetch_metadata tool to read existing tables metadata by providing the original user query
 - to fetch real data you must generate a SQL query and must call the execute_sql tool to run it.
 - when calling the execute_sql tool always provide a meaningful_filename used to save the result in. It can be long and should be descriptive of the query
+- when several independent queries are needed call the execute_sql tool once for each of them in the same message, they run concurrently and each result is kept
 
 When generating and running queries always remember:
 - Use only tables and columns you know exist by seeing them in the metadata
@@ -81,7 +82,7 @@ Generate correct python programs that adhere to the specification and do the fea
 To run python programs you have access to the python_interpreter tool available.
 
 Remember:
-- Data previews are available in the context and the full data can always be found at the csv file path indicated here.
+- Data previews are available in the context and the full data can always be found at the file path indicated here. {result_loading}
 - If the user didn't request any postprocessing of the fetched data simply skip the task and terminate with success right away.
 - When generating a script to run ALWAYS include meaningful prints, std output will be captured and included in this prompt if scripts have been run before
 - ALWAYS persist the requested output of the program in files inside the dedicated './output' directory
@@ -93,9 +94,33 @@ Previous python execution:
 {python_output}
 """
 
+result_loading = {
+    "csv": "Results are csv files, load them with `pd.read_csv(path)`.",
+    "parquet": "Results are parquet files keeping the original column types, load them with `pd.read_parquet(path)`.",
+    "arrow": "Results are Arrow IPC files keeping the original column types, load them memory-mapped with `pa.ipc.open_file(pa.memory_map(path)).read_all()` after `import pyarrow as pa`, and call `.to_pandas()` on the table if you need a DataFrame.",
+}
+
+result_helper = "Prefer `df = load_result(name)` (already defined, no import needed) with the result file name: it returns a pandas DataFrame without reading the file again if it was already loaded, `load_result(name, arrow=True)` returns a pyarrow Table instead."
+
+inline_sufficiency = "Once the data fetched so far is enough to answer the user question call the finish_data_fetching tool, alone, instead of fetching more data."
+
+partial_metadata = "The metadata above only describes the tables retrieved for the user question, don't fetch it again: call the fetch_metadata tool only if other tables are needed, describing them in its user_question."
+
+lookup_question = (
+    r"^\s*(how many|how much|what is|what's|what are|who is|list|show|count)\b"
+)
+
+not_lookup_question = r"\b(and|or|than|compare|versus|vs|trend|over time|plot|chart|graph|why|ratio|rate|share|percentage|correlat\w*|most|least|highest|lowest|best|worst|top|explore|analy[sz]e|analysis|insights?|overview|summar\w*|pattern\w*)\b"
+
 en_prompts = Prompts(
     sql_generation=en_sql_generation,
     final_answer=en_final_answer,
     evaluate_context=evaluate_context,
     python_opt_generation=python_opt_generation,
+    result_loading=result_loading,
+    result_helper=result_helper,
+    inline_sufficiency=inline_sufficiency,
+    partial_metadata=partial_metadata,
+    lookup_question=lookup_question,
+    not_lookup_question=not_lookup_question,
 )
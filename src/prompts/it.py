@@ -3,6 +3,7 @@ from src.prompts.prompt_schema import Prompts
 
 it_sql_generation = """Sei un esperto di database. Genera una query SQL valida per raccogliere dati utili a rispondere alla domanda dell'utente.
 Dopo aver generato la query DEVI chiamare il tool execute_sql per eseguirla.
+Se servono più query indipendenti chiama execute_sql una volta per ciascuna nello stesso messaggio, vengono eseguite in parallelo.
 - Usa solo tabelle e colonne nello schema indicato sotto
 - Non utilizzare CREATE, DROP, INSERT, UPDATE, DELETE, o qualunque altro statemente con side effects
 - Genera soltanto la query SQL. Nessuna spiegazione, no markdown, no commenti
@@ -21,9 +22,33 @@ Dati:
 {data}
 """
 
+it_result_loading = {
+    "csv": "I risultati sono file csv, caricali con `pd.read_csv(path)`.",
+    "parquet": "I risultati sono file parquet che mantengono i tipi originali delle colonne, caricali con `pd.read_parquet(path)`.",
+    "arrow": "I risultati sono file Arrow IPC che mantengono i tipi originali delle colonne, caricali mappandoli in memoria con `pa.ipc.open_file(pa.memory_map(path)).read_all()` dopo `import pyarrow as pa`, e chiama `.to_pandas()` sulla tabella se ti serve un DataFrame.",
+}
+
+it_result_helper = "Preferisci `df = load_result(nome)` (già definita, non serve importarla) con il nome del file del risultato: restituisce un DataFrame pandas senza rileggere il file se era già stato caricato, `load_result(nome, arrow=True)` restituisce invece una Table pyarrow."
+
+it_inline_sufficiency = "Quando i dati raccolti finora sono sufficienti a rispondere alla domanda dell'utente chiama il tool finish_data_fetching, da solo, invece di raccogliere altri dati."
+
+it_partial_metadata = "Lo schema sopra descrive solo le tabelle trovate per la domanda dell'utente, non recuperarlo di nuovo: chiama il tool fetch_metadata solo se servono altre tabelle, descrivendole nel suo user_question."
+
+it_lookup_question = (
+    r"^\s*(quant[ieoa]|qual è|quali sono|chi è|elenca|mostra|mostrami|conta)\b"
+)
+
+it_not_lookup_question = r"\b(e|o|oppure|rispetto|confronta\w*|contro|vs|andamento|nel tempo|grafico|perch[ée]|rapporto|tasso|quota|percentual\w*|correla\w*|più|meno|maggior\w*|minor\w*|miglior\w*|peggior\w*|top|esplora|analizza|analisi|panoramica|riassum\w*|riepilogo|tendenz\w*)\b"
+
 it_prompts = Prompts(
     sql_generation=it_sql_generation,
     final_answer=it_final_answer,
     evaluate_context="",
     python_opt_generation="",
+    result_loading=it_result_loading,
+    result_helper=it_result_helper,
+    inline_sufficiency=it_inline_sufficiency,
+    partial_metadata=it_partial_metadata,
+    lookup_question=it_lookup_question,
+    not_lookup_question=it_not_lookup_question,
 )
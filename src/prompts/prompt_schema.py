@@ -7,3 +7,17 @@ class Prompts:
     final_answer: str
     evaluate_context: str
     python_opt_generation: str
+    # instructions on how to load a query result file, by result format
+    result_loading: dict[str, str]
+    # instructions on the `load_result` helper available to pooled python scripts
+    result_helper: str
+    # appended to sql_generation when the generation node decides when data is enough
+    inline_sufficiency: str
+    # appended to sql_generation when the metadata only describes the tables retrieved
+    # for the question
+    partial_metadata: str
+    # questions answered by a single query result (regex matched at the start, ignoring
+    # case): the sufficiency evaluation is skipped once their query succeeded
+    lookup_question: str
+    # anything hinting at comparisons, multiple steps, postprocessing or exploration
+    not_lookup_question: str
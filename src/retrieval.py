@@ -0,0 +1,120 @@
+from collections import Counter
+from functools import lru_cache
+import math
+import re
+from src.catalog import SchemaCatalog
+
+
+# fmt: off
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "by", "for", "from", "how", "in", "is", "it", "me",
+    "of", "on", "or", "show", "the", "to", "what", "which", "who", "with", "many",
+    "much", "per", "each", "all", "give", "list", "get", "tell", "there", "do", "does",
+}
+# fmt: on
+# repetition of tokens from more specific fields boosts their weight in BM25
+TABLE_NAME_WEIGHT = 3
+COLUMN_NAME_WEIGHT = 2
+
+_WORD = re.compile(r"\w+")
+# splits camelCase, PascalCase and acronyms: "userIDMapping" -> user, ID, Mapping
+_IDENTIFIER_PART = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits `text` in lowercase terms, breaking identifiers on snake_case and camelCase
+    boundaries. Compound identifiers are also kept whole so exact names rank higher"""
+    tokens = []
+    for word in _WORD.findall(text):
+        parts = _IDENTIFIER_PART.findall(word)
+        for part in parts:
+            part = _normalize(part)
+            if part and part not in STOPWORDS:
+                tokens.append(part)
+        if len(parts) > 1:
+            tokens.append(word.lower())
+    return tokens
+
+
+def _normalize(term: str) -> str:
+    term = term.lower()
+    # naive plural stripping so that "customers" matches "customer"
+    if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        term = term[:-1]
+    return term
+
+
+class BM25Index:
+    def __init__(
+        self, documents: dict[str, list[str]], k1: float = 1.5, b: float = 0.75
+    ):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = {name: Counter(tokens) for name, tokens in documents.items()}
+        self.lengths = {name: len(tokens) for name, tokens in documents.items()}
+        self.avg_length = sum(self.lengths.values()) / max(len(documents), 1)
+
+        doc_freqs = Counter()
+        for freqs in self.term_freqs.values():
+            doc_freqs.update(freqs.keys())
+        n = len(documents)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freqs.items()
+        }
+        # inverted index so that scoring only touches documents sharing a term
+        self.postings: dict[str, list[str]] = {}
+        for name, freqs in self.term_freqs.items():
+            for term in freqs:
+                self.postings.setdefault(term, []).append(name)
+
+    def search(self, query: str) -> list[tuple[str, float]]:
+        """Returns `(document, score)` pairs sorted by descending score"""
+        scores: dict[str, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for name in self.postings[term]:
+                tf = self.term_freqs[name][term]
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.lengths[name] / self.avg_length
+                )
+                scores[name] = scores.get(name, 0.0) + idf * tf * (self.k1 + 1) / (
+                    tf + norm
+                )
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+@lru_cache(maxsize=4)
+def get_table_index(catalog: SchemaCatalog) -> BM25Index:
+    """Builds (once per catalog version) the BM25 index over the catalog tables"""
+    documents = {}
+    for full_table_name, table in catalog.tables.items():
+        tokens = tokenize(full_table_name) * TABLE_NAME_WEIGHT
+        tokens += tokenize(table.get("description") or "")
+        for column in table.get("columns", []):
+            tokens += tokenize(column["name"]) * COLUMN_NAME_WEIGHT
+            tokens += tokenize(column.get("description") or "")
+        documents[full_table_name] = tokens
+
+    return BM25Index(documents)
+
+
+def search_tables(
+    catalog: SchemaCatalog, question: str, top_k: int = 10, char_budget: int = 5000
+) -> list[str]:
+    """Returns the names of the tables most relevant to `question`, at most `top_k`
+    and stopping before their rendered description exceeds `char_budget` characters"""
+    selected = []
+    used = 0
+    for full_table_name, _ in get_table_index(catalog).search(question)[:top_k]:
+        size = len(catalog.snippets[full_table_name])
+        # the best match is always returned even if alone it's over budget
+        if selected and used + size > char_budget:
+            break
+        selected.append(full_table_name)
+        used += size
+
+    return selected
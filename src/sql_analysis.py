@@ -0,0 +1,147 @@
+from difflib import get_close_matches
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+from src.catalog import SchemaCatalog
+
+
+DIALECT = "bigquery"
+
+
+def analyze_query(
+    query: str, catalog: SchemaCatalog | None, project: str | None = None
+) -> None:
+    """Statically checks `query` before it's sent to the database, raising `ValueError`
+    with a precise explanation if it's not a single read only statement or if it
+    references tables or columns missing from the `catalog` (skipped if `None`).
+    Tables of projects other than `project` are not checked.
+    Checks are conservative: anything that can't be resolved with certainty is accepted
+    """
+    try:
+        statements = [s for s in sqlglot.parse(query, read=DIALECT) if s is not None]
+    except ParseError as e:
+        raise ValueError(f"Syntax error: {e}")
+
+    if len(statements) != 1:
+        raise ValueError(f"Exactly one statement is allowed, found {len(statements)}")
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        raise ValueError(
+            f"Only SELECT queries are allowed, found {statement.key.upper()}. DB altering statements have been disabled"
+        )
+    # DML/DDL can't be nested in a query but make sure of it anyway
+    for node in statement.walk():
+        if isinstance(node, (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Drop)):
+            raise ValueError(
+                f"{node.key.upper()} is forbidden in this environment. DB altering statements have been disabled"
+            )
+
+    if catalog is None:
+        return
+    tables_by_alias = _resolve_tables(statement, catalog, project)
+    _check_columns(statement, catalog, tables_by_alias)
+
+
+def _resolve_tables(
+    statement: exp.Expression, catalog: SchemaCatalog, project: str | None
+) -> dict:
+    """Checks that every table read by the query exists in the catalog.
+    Returns the catalog tables (or `None` if unknown) by the alias used in the query"""
+    cte_names = {cte.alias_or_name.lower() for cte in statement.find_all(exp.CTE)}
+    lowercase_tables = {name.lower(): name for name in catalog.tables}
+    tables_by_alias = {}
+
+    for table in statement.find_all(exp.Table):
+        if not table.db and table.name.lower() in cte_names:
+            tables_by_alias[table.alias_or_name] = None
+            continue
+        # the BigQuery dialect keeps the view in the name, e.g. INFORMATION_SCHEMA.COLUMNS
+        if any(
+            part.name.lower().split(".")[0] == "information_schema"
+            for part in table.parts
+        ) or (table.catalog and table.catalog != project):
+            tables_by_alias[table.alias_or_name] = None
+            continue
+
+        full_table_name = f"{table.db}.{table.name}" if table.db else table.name
+        if full_table_name.endswith("*"):
+            # wildcard tables: at least one table must match the prefix
+            prefix = full_table_name.rstrip("*").lower()
+            if not any(name.startswith(prefix) for name in lowercase_tables):
+                raise ValueError(
+                    f"No table matches the wildcard {full_table_name}{_suggest(full_table_name, catalog.tables)}"
+                )
+            tables_by_alias[table.alias_or_name] = None
+            continue
+
+        catalog_name = lowercase_tables.get(full_table_name.lower())
+        if catalog_name is None:
+            raise ValueError(
+                f"Table {full_table_name} doesn't exist. Tables must be referenced as dataset.table{_suggest(full_table_name, catalog.tables)}"
+            )
+        tables_by_alias[table.alias_or_name] = catalog_name
+        # the table can also be referenced by its bare name when not aliased
+        tables_by_alias.setdefault(table.name, catalog_name)
+
+    return tables_by_alias
+
+
+def _check_columns(
+    statement: exp.Expression, catalog: SchemaCatalog, tables_by_alias: dict
+) -> None:
+    read_tables = {name for name in tables_by_alias.values() if name is not None}
+    if not read_tables or None in tables_by_alias.values():
+        # reading from CTEs or wildcard tables, unqualified columns can't be resolved
+        unqualified_columns = None
+    else:
+        unqualified_columns = {
+            column["name"].lower()
+            for table in read_tables
+            for column in catalog.tables[table].get("columns", [])
+        }
+    # names defined by the query itself: select aliases, CTE/subquery/unnest aliases
+    defined_names = {
+        node.alias.lower() for node in statement.find_all(exp.Alias) if node.alias
+    }
+    for table_alias in statement.find_all(exp.TableAlias):
+        defined_names.add(table_alias.name.lower())
+        defined_names.update(column.name.lower() for column in table_alias.columns)
+
+    for column in statement.find_all(exp.Column):
+        if isinstance(column.this, exp.Star):
+            # qualified star, e.g. `o.*`, the alias was already resolved
+            continue
+        name = column.name
+        if not name or name.startswith("_") or name.lower() in defined_names:
+            # pseudo columns like _PARTITIONTIME or names defined in the query
+            continue
+
+        if column.table:
+            table_name = tables_by_alias.get(column.table)
+            if table_name is None:
+                # struct field access, CTEs, subqueries...
+                continue
+            candidates = [c["name"] for c in catalog.tables[table_name]["columns"]]
+            if name.lower() not in {c.lower() for c in candidates}:
+                raise ValueError(
+                    f"Column {name} doesn't exist in table {table_name}{_suggest(name, candidates)}"
+                )
+        elif (
+            unqualified_columns is not None and name.lower() not in unqualified_columns
+        ):
+            candidates = [
+                c["name"]
+                for table in read_tables
+                for c in catalog.tables[table].get("columns", [])
+            ]
+            raise ValueError(
+                f"Column {name} doesn't exist in any of the tables {', '.join(sorted(read_tables))}{_suggest(name, candidates)}"
+            )
+
+
+def _suggest(name: str, candidates) -> str:
+    by_lowercase = {candidate.lower(): candidate for candidate in candidates}
+    matches = get_close_matches(name.lower(), list(by_lowercase), n=3, cutoff=0.6)
+    if not matches:
+        return ""
+    return ". Did you mean " + " or ".join(by_lowercase[m] for m in matches) + "?"
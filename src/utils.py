@@ -1,9 +1,19 @@
+import hashlib
 from langchain.messages import AnyMessage
 from langgraph.graph.state import CompiledStateGraph
+import os
+import shutil
+from src.cache import CACHE_DIRECTORY
 from src.logger import logger
 
 
+# seconds waited for mermaid.ink before falling back to the mermaid source
+GRAPH_RENDER_TIMEOUT = 10
+
+
 def get_user_question(state) -> str:
+    if state.get("user_question"):
+        return state["user_question"]
     user_query = None
     for msg in reversed(state["messages"]):
         if msg.type == "human":
@@ -19,11 +29,15 @@ def content_as_string(message: AnyMessage) -> str:
     """Takes a langchain message and returns the content string"""
 
     content = message.content
+    if isinstance(content, str):
+        return content
+
     if isinstance(content, list):
         content = ""
-        for block in content:
+        for block in message.content:
             if isinstance(block, dict):
-                content += block["text"]
+                # tool calls and other non text blocks have no text
+                content += block.get("text", "")
             elif isinstance(block, str):
                 content += block
             else:
@@ -42,7 +56,11 @@ def print_graph(
     tool_nodes=[],
     llm_control_nodes=[],
     llm_nodes=[],
-):
+    output_path: str = "graph.png",
+) -> str:
+    """Renders the graph to `output_path` through mermaid.ink. Renders are cached by the
+    hash of the mermaid source, when the service can't be reached the source is written
+    next to `output_path` as .mmd instead. Returns the path written"""
     # i dont like these kinds of imports but at this stage who cares tbh
     import requests
     import base64
@@ -62,9 +80,32 @@ def print_graph(
         custom_styles.append(f"style {node} fill:#3498db,color:#fff")
 
     styled_mermaid = mermaid_code + "\n" + "\n".join(custom_styles)
-    response = requests.get(
-        "https://mermaid.ink/img/"
-        + base64.urlsafe_b64encode(styled_mermaid.encode()).decode()
-    )
-    with open("graph.png", "wb") as f:
+    digest = hashlib.sha256(styled_mermaid.encode()).hexdigest()
+    cached_path = os.path.join(CACHE_DIRECTORY, "graphs", f"{digest}.png")
+    if os.path.exists(cached_path):
+        logger.debug(f"Graph render cache hit {cached_path}")
+        shutil.copyfile(cached_path, output_path)
+        return output_path
+
+    try:
+        response = requests.get(
+            "https://mermaid.ink/img/"
+            + base64.urlsafe_b64encode(styled_mermaid.encode()).decode(),
+            timeout=GRAPH_RENDER_TIMEOUT,
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        mermaid_path = os.path.splitext(output_path)[0] + ".mmd"
+        # the exception message repeats the whole encoded url
+        logger.warning(
+            f"Graph rendering failed ({type(e).__name__}), writing {mermaid_path} instead"
+        )
+        with open(mermaid_path, "w", encoding="utf-8") as f:
+            f.write(styled_mermaid)
+        return mermaid_path
+
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    with open(cached_path, "wb") as f:
         f.write(response.content)
+    shutil.copyfile(cached_path, output_path)
+    return output_path